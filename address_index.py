@@ -0,0 +1,179 @@
+from array import array
+from bisect import bisect_left
+import threading
+
+from utility.hash_util import hash_block
+
+SENT = 1
+RECEIVED = 2
+_ROLE_NAMES = {SENT: 'sent', RECEIVED: 'received', SENT | RECEIVED: 'self'}
+
+
+def _pack(height, position, roles):
+    # One sortable integer per entry: entries of an address in chain order are increasing numbers
+    return height << 32 | position << 2 | roles
+
+
+def _unpack(entry):
+    return entry >> 32, (entry >> 2) & 0x3FFFFFFF, entry & 3
+
+
+def _block_entries(block):
+    """ Return the (address, packed entry) pairs of a block's transactions, one per address and transaction """
+    entries = []
+    for position, tx in enumerate(block.transactions):
+        if tx.sender == tx.recipient:
+            entries.append((tx.sender, _pack(block.index, position, SENT | RECEIVED)))
+        else:
+            entries.append((tx.sender, _pack(block.index, position, SENT)))
+            entries.append((tx.recipient, _pack(block.index, position, RECEIVED)))
+    return entries
+
+
+class AddressIndex:
+    """ Maps every address to the positions (block height, transaction position) of its transactions as sender
+        or recipient, so an address's history is read page by page instead of by scanning the chain.
+
+    Attributes:
+        :entries (private): Sorted array of packed (height, position, roles) entries per address
+        :height (private): The number of blocks indexed
+        :storage (private): Persists the index as a log of the entries per block next to the block log
+        :source (private): The chain to bring the index up to date with on first use
+        :build_lock (private): Readers arriving during that first build wait for it instead of seeing a partial index
+    """
+    def __init__(self, storage):
+        self.__entries = {}
+        self.__height = 0
+        self.__storage = storage
+        self.__source = None
+        self.__build_lock = threading.Lock()
+
+    def rebuild(self, chain, load_checkpoint=None):
+        """ Bring the index in line with a whole loaded chain. Deferred to the first use like the ledger: the stored
+            index gets loaded then and only the blocks it misses are scanned
+
+        Arguments:
+            :load_checkpoint: Optional function returning a checkpoint of this chain or None. Its index state (see
+                snapshot) is loaded then, only the log written after it gets replayed
+        """
+        self.__source = (chain, len(chain), load_checkpoint)
+
+    def __ensure_built(self):
+        if self.__source is None:
+            return
+        with self.__build_lock:
+            if self.__source is None: # built by another thread meanwhile
+                return
+            chain, height, load_checkpoint = self.__source
+            checkpoint = load_checkpoint() if load_checkpoint is not None else None
+            state = checkpoint.get('addresses') if checkpoint else None
+            replayed = self.__replay(chain, height, checkpoint['height'], state) if state else None
+            if replayed is None: # no usable checkpoint, the whole stored log then
+                replayed = self.__replay(chain, height, 0, None)
+            if replayed is None:
+                print('Rebuilding address index, it does not match the chain')
+                self.__entries = {}
+                self.__height = 0
+                replayed = ([], True)
+            blocks, compact = replayed
+            # Index the blocks the stored log misses, e.g. after a crash between the block and its entries
+            missing = [self.__record(chain[index]) for index in range(self.__height, height)]
+            for record in missing:
+                self.__add(record['height'], record['entries'])
+            if compact:
+                self.__storage.write_address_log(blocks + missing)
+            elif missing:
+                self.__storage.append_address_records(missing)
+            self.__source = None # only now the index is complete
+
+    def __replay(self, chain, height, base, state):
+        """ Load the index from a checkpoint's state at height base (or from nothing, base 0) and the stored log
+            written after it. Returns (the replayed block records, whether the log should be compacted), None if
+            the log doesn't match the chain """
+        records = self.__storage.load_address_log(state['offset'] if state else 0)
+        if records is None:
+            return None
+        # A block record per height, a revert record drops the heights from there on
+        blocks = []
+        compact = False
+        for record in records:
+            if 'revert' in record:
+                if record['revert'] < base: # a fork below the checkpoint, it should have been dropped
+                    return None
+                del blocks[record['revert'] - base:]
+                compact = True
+            elif record.get('height') == base + len(blocks):
+                blocks.append(record)
+        end = base + len(blocks)
+        if end > height or (blocks and blocks[-1]['hash'] != hash_block(chain[end - 1])):
+            return None
+        self.__entries = {address: array('Q', entries) for address, entries in state['entries'].items()} if state else {}
+        self.__height = base
+        for record in blocks:
+            self.__add(record['height'], record['entries'])
+        # Only a whole log can be rewritten without its reverts, the one after a checkpoint is replayed as it is
+        return blocks, compact and state is None
+
+    def snapshot(self):
+        """ Return the index as a checkpoint dict: the entries per address and the log offset to replay from """
+        self.__ensure_built()
+        return {'offset': self.__storage.address_log_size(), 'entries': {address: list(entries) for address, entries in self.__entries.items()}}
+
+    @staticmethod
+    def __record(block):
+        return {'height': block.index, 'hash': hash_block(block), 'entries': _block_entries(block)}
+
+    def __add(self, height, entries):
+        for address, entry in entries:
+            address_entries = self.__entries.get(address)
+            if address_entries is None:
+                address_entries = self.__entries[address] = array('Q')
+            address_entries.append(entry)
+        self.__height = height + 1
+
+    def apply_block(self, block):
+        """ Index the transactions of a newly appended block and store its entries """
+        self.__ensure_built()
+        record = self.__record(block)
+        self.__add(record['height'], record['entries'])
+        self.__storage.append_address_records([record])
+
+    def revert_block(self, block):
+        """ Drop the entries of a block which gets replaced (fork), and of every block after it """
+        self.__ensure_built()
+        first_entry = _pack(block.index, 0, 0)
+        for tx in block.transactions:
+            for address in (tx.sender, tx.recipient):
+                address_entries = self.__entries.get(address)
+                while address_entries and address_entries[-1] >= first_entry:
+                    address_entries.pop()
+        if block.index < self.__height:
+            self.__height = block.index
+            self.__storage.append_address_records([{'revert': block.index}])
+
+    def history(self, address, cursor=None, limit=50, height=None):
+        """ Return one page of an address's transactions, newest first
+
+        Arguments:
+            :cursor: The (height, position) of the last entry of the previous page, None for the first page
+            :limit: The maximum number of entries of the page
+            :height: Only entries below that block height, e.g. the height of a chain snapshot
+        Returns:
+            ([(height, position, role name)], cursor of the next page or None after the last page)
+        """
+        self.__ensure_built()
+        address_entries = self.__entries.get(address)
+        if not address_entries:
+            return [], None
+        end = len(address_entries)
+        if height is not None:
+            end = bisect_left(address_entries, _pack(height, 0, 0))
+        if cursor is not None:
+            end = min(end, bisect_left(address_entries, _pack(cursor[0], cursor[1], 0)))
+        start = max(end - limit, 0)
+        page = []
+        for entry in reversed(address_entries[start:end]): # a slice of the page only, whatever the history's length
+            entry_height, position, roles = _unpack(entry)
+            page.append((entry_height, position, _ROLE_NAMES[roles]))
+        next_cursor = (page[-1][0], page[-1][1]) if start > 0 and page else None
+        return page, next_cursor
@@ -0,0 +1,4 @@
+""" Benchmarks of the node's hot paths on synthetic chains, run with: python -m benchmarks --help
+
+The results are printed (or written) as JSON so that runs of different commits can be compared.
+"""
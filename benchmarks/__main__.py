@@ -0,0 +1,72 @@
+""" Run the benchmarks: python -m benchmarks [--height 200] [--only hash_block verify_chain] [--output results.json] """
+
+from argparse import ArgumentParser
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+from benchmarks.cases import CASES, BenchContext
+from benchmarks.chain_factory import make_chain, make_wallets
+
+
+def git_commit():
+    """ The commit the benchmarked code is at, None outside of a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--height', type=int, default=200, help='blocks of the synthetic chain, the genesis block included')
+    parser.add_argument('--wallets', type=int, default=5, help='wallets sending transactions to each other')
+    parser.add_argument('--tx-per-block', type=int, default=10, help='signed transactions per block')
+    parser.add_argument('--difficulty', type=int, default=4, help='proof of work difficulty of the synthetic chain')
+    parser.add_argument('--pow-difficulty', type=int, default=12, help='difficulty of the proof_of_work benchmark')
+    parser.add_argument('--mempool-size', type=int, default=500, help='open transactions for the add_block and load/save benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('--only', nargs='+', choices=sorted(CASES), help='run only these benchmarks')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='blockchain-bench-') # the storage folders of the benchmarked nodes
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(sys.stderr): # the node prints progress, stdout is for the results
+            wallets = make_wallets(options.wallets)
+            chain = make_chain(wallets, options.height, options.tx_per_block, options.difficulty)
+            context = BenchContext(wallets, chain, options)
+            results = {}
+            for name in options.only or CASES:
+                print('Running {}'.format(name))
+                results[name] = CASES[name](context)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(options).items() if key != 'output'},
+        'results': results # seconds
+    }
+    if options.output:
+        with open(options.output, mode='w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
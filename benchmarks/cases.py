@@ -0,0 +1,184 @@
+""" The benchmark cases, each one times a hot path of the node on a synthetic chain """
+
+import itertools
+import os
+import statistics
+from time import perf_counter
+
+from blockchain import Blockchain
+from utility.hash_util import hash_block
+from utility.storage import Storage
+from utility.verification import Verification
+from benchmarks.chain_factory import mine_on, sign_transactions, tx_amount, unsealed_copy
+
+FRESH_OFFSET = 500000 # numbers of the transactions made during a run, the synthetic chain uses the ones below
+
+_node_ids = itertools.count(7000) # every Blockchain of a run gets its own storage folder
+
+
+def measure(run, repeat, setup=None):
+    """ Time a function repeat times and return the statistics in seconds
+
+    Arguments:
+        :run: The timed function, it gets the result of setup if given
+        :setup: Optional function called before every run and not timed
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = perf_counter()
+            run()
+        else:
+            state = setup()
+            start = perf_counter()
+            run(state)
+        times.append(perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'max': max(times)
+    }
+
+
+class BenchContext:
+    """ What the cases share: the wallets, the synthetic chain and the command line options
+
+    Attributes:
+        :wallets: The wallets sending the transactions, the first one is the node's
+        :chain: The synthetic chain, a list of sealed blocks
+        :options: The parsed command line options
+    """
+    def __init__(self, wallets, chain, options):
+        self.wallets = wallets
+        self.chain = chain
+        self.options = options
+        self.__next_number = FRESH_OFFSET
+
+    def fresh_transactions(self, count):
+        """ Signed transactions which are in no block yet """
+        transactions = sign_transactions(self.wallets, count, self.__next_number)
+        self.__next_number += count
+        return transactions
+
+    def fresh_amount(self):
+        """ An amount which makes a transaction unlike all others """
+        self.__next_number += 1
+        return tx_amount(self.__next_number - 1)
+
+    def new_blockchain(self, **kwargs):
+        """ A Blockchain of the first wallet which loads the synthetic chain from a new storage folder """
+        node_id = next(_node_ids)
+        Storage(node_id).replace_blocks([block.to_dict() for block in self.chain])
+        kwargs.setdefault('difficulty', self.options.difficulty)
+        kwargs.setdefault('gossip_window', 0)
+        return Blockchain(self.wallets[0].public_key, node_id, **kwargs)
+
+
+def bench_hash_block(context):
+    copies = [unsealed_copy(block) for block in context.chain]
+    result = measure(lambda: [hash_block(block) for block in copies], context.options.repeat)
+    result['per_block'] = result['median'] / len(copies)
+    return result
+
+
+def bench_verify_chain(context):
+    result = measure(lambda: Verification.verify_chain(context.chain, context.options.difficulty), context.options.repeat)
+    result['per_block'] = result['median'] / len(context.chain)
+    return result
+
+
+def bench_proof_of_work(context):
+    blockchain = context.new_blockchain(difficulty=context.options.pow_difficulty)
+    roots = iter([os.urandom(32).hex() for _ in range(context.options.repeat)]) # another search space each run
+    result = measure(lambda: blockchain.proof_of_work(next(roots)), context.options.repeat)
+    stats = blockchain.get_mining_stats()
+    result['difficulty'] = context.options.pow_difficulty
+    result['hash_rate'] = stats['hash_rate']
+    return result
+
+
+def bench_get_balance(context):
+    """ The first call builds the ledger from the chain, the next ones are lookups """
+    first = measure(lambda blockchain: blockchain.get_balance(), context.options.repeat, setup=context.new_blockchain)
+    blockchain = context.new_blockchain()
+    blockchain.get_balance()
+    cached = measure(lambda: [blockchain.get_balance(wallet.public_key) for wallet in context.wallets], context.options.repeat)
+    return {'first': first, 'cached': cached}
+
+
+def bench_load_save(context):
+    blockchain = context.new_blockchain()
+    blockchain.add_transactions([tx.to_dict() for tx in context.fresh_transactions(context.options.mempool_size)])
+    return {
+        'load_data': measure(blockchain.load_data, context.options.repeat),
+        'save_data': measure(blockchain.save_data, context.options.repeat)
+    }
+
+
+def bench_add_block(context):
+    """ A received block whose transactions fill the mempool, most of the time goes into removing them """
+    transactions = context.fresh_transactions(context.options.mempool_size)
+    block = mine_on(context.chain[-1], transactions, context.wallets[1], context.options.difficulty).to_dict()
+    def setup():
+        blockchain = context.new_blockchain()
+        blockchain.add_transactions([tx.to_dict() for tx in transactions])
+        return blockchain
+    def run(blockchain):
+        if not blockchain.add_block(block):
+            raise RuntimeError('Benchmark block was declined')
+    result = measure(run, context.options.repeat, setup=setup)
+    result['transactions'] = len(transactions)
+    return result
+
+
+def bench_endpoints(context):
+    """ The Flask routes through the test client, without a network """
+    import node # the Flask app, it reads the module globals set below
+
+    node.port = next(_node_ids)
+    node.wallet = context.wallets[0]
+    node.blockchain = context.new_blockchain()
+    client = node.app.test_client()
+    repeat = context.options.repeat
+    results = {}
+
+    def get_chain():
+        response = client.get('/chain')
+        if response.status_code != 200:
+            raise RuntimeError('GET /chain failed: {}'.format(response.status_code))
+        response.get_data()
+    results['chain'] = measure(get_chain, repeat)
+
+    # Blocks extending the tip one after the other, one per run
+    blocks = []
+    tip = context.chain[-1]
+    for _ in range(repeat):
+        tip = mine_on(tip, context.fresh_transactions(context.options.tx_per_block), context.wallets[1], context.options.difficulty)
+        blocks.append(tip.to_dict())
+    blocks = iter(blocks)
+    def broadcast_block():
+        response = client.post('/broadcast-block', json={'block': next(blocks)})
+        if response.status_code != 201:
+            raise RuntimeError('POST /broadcast-block failed: {}'.format(response.status_code))
+    results['broadcast_block'] = measure(broadcast_block, repeat)
+
+    recipient = context.wallets[1].public_key
+    def add_transaction():
+        response = client.post('/transaction', json={'recipient': recipient, 'amount': context.fresh_amount()})
+        if response.status_code != 201:
+            raise RuntimeError('POST /transaction failed: {}'.format(response.status_code))
+    results['transaction'] = measure(add_transaction, repeat)
+    return results
+
+
+CASES = {
+    'hash_block': bench_hash_block,
+    'verify_chain': bench_verify_chain,
+    'proof_of_work': bench_proof_of_work,
+    'get_balance': bench_get_balance,
+    'load_save': bench_load_save,
+    'add_block': bench_add_block,
+    'endpoints': bench_endpoints
+}
@@ -0,0 +1,78 @@
+""" Builds synthetic chains of blocks with signed transactions between a set of wallets """
+
+from block import Block
+from blockchain import MINING_REWARD
+from transaction import Transaction
+from utility.hash_util import hash_block, merkle_root, seal_block
+from utility.pow_engine import ProofOfWorkEngine
+from wallet import Wallet
+
+TX_AMOUNT = 0.01 # small enough that the senders never run out of mining rewards
+
+
+def tx_amount(number):
+    """ The amount of the transaction with a given number, slightly different for each one
+        so that no two transactions are the same (same content, same id) """
+    return TX_AMOUNT + number * 1e-8
+
+
+def make_wallets(count, first_id=9000):
+    """ Return count wallets with fresh keys, they are not saved to files """
+    wallets = []
+    for node_id in range(first_id, first_id + count):
+        wallet = Wallet(node_id)
+        wallet.create_keys()
+        wallets.append(wallet)
+    return wallets
+
+
+def genesis_block():
+    """ The same genesis block every Blockchain starts with """
+    return seal_block(Block(0, '', [], 100, 0))
+
+
+def sign_transactions(wallets, count, offset=0):
+    """ Return count signed transactions numbered from offset on, each wallet sends to the next one in turn """
+    transactions = []
+    for number in range(offset, offset + count):
+        sender = wallets[number % len(wallets)]
+        recipient = wallets[(number + 1) % len(wallets)]
+        amount = tx_amount(number)
+        signature = sender.sign_transaction(sender.public_key, recipient.public_key, amount)
+        transactions.append(Transaction(sender.public_key, recipient.public_key, signature, amount))
+    return transactions
+
+
+def mine_on(previous_block, transactions, miner, difficulty, timestamp=None):
+    """ Return a sealed block with a valid proof of work on top of a block, the miner's reward is appended
+
+    Arguments:
+        :transactions: The signed transactions of the block
+        :miner: The wallet getting the mining reward
+    """
+    transactions = list(transactions) + [Transaction('MINING', miner.public_key, '', MINING_REWARD)]
+    root = merkle_root([tx.id for tx in transactions])
+    previous_hash = hash_block(previous_block)
+    proof = ProofOfWorkEngine.shared().search(None, previous_hash, difficulty, root)
+    return seal_block(Block(previous_block.index + 1, previous_hash, transactions, proof, timestamp, root))
+
+
+def make_chain(wallets, height, tx_per_block, difficulty):
+    """ Return a valid chain of height blocks (the genesis block included). Every wallet mines one of the
+        first blocks, the later blocks hold tx_per_block transactions between the wallets.
+    """
+    chain = [genesis_block()]
+    offset = 0
+    for index in range(1, height):
+        if index <= len(wallets):
+            transactions = [] # the wallets earn their first coins
+        else:
+            transactions = sign_transactions(wallets, tx_per_block, offset)
+            offset += tx_per_block
+        chain.append(mine_on(chain[-1], transactions, wallets[index % len(wallets)], difficulty, timestamp=index))
+    return chain
+
+
+def unsealed_copy(block):
+    """ A copy of a block without the cached hash, so that hash_block does the full work again """
+    return Block(block.index, block.previous_hash, block.transactions, block.proof, block.timestamp, block.merkle_root)
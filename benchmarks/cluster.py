@@ -0,0 +1,339 @@
+""" Runs a local network of nodes and drives a load of transactions and mining against it
+
+    python -m benchmarks.cluster [--nodes 3] [--duration 20] [--tx-rate 20] [--mine-rate 0.2] [-- --difficulty 10]
+
+Every node is a node.py process on its own port and in its own working directory (wallet, block log, mempool
+journal), the nodes know each other as peers. The load is open-loop: the requests go out on a fixed schedule
+whatever the nodes' response times, and a late request counts from when it was due.
+Reported as JSON:
+    :transactions: submitted, accepted, throughput and the propagation latency (submit to present
+                   in every node's /transactions) in seconds
+    :mining: the mining jobs started and the height of every node at the end
+    :convergence: seconds from the first /resolve-conflicts round until every node has the same tip
+"""
+
+from argparse import ArgumentParser, REMAINDER
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep, time
+
+import requests
+
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'node.py')
+TX_AMOUNT = 0.001 # every transaction sends slightly more than the one before so that no two are the same
+
+
+class Cluster:
+    """ A set of node.py processes on localhost which are peers of each other
+
+    Attributes:
+        :ports: The port of every node
+        :keys: The public key of every node's wallet, once started
+        :node_args: Extra command line arguments of every node, e.g. ['--difficulty', '10']
+        :log_dir: The folder for the output of every node, None discards it
+        :workdirs (private): The working directory of every node, removed on stop
+        :processes (private): The running node processes
+    """
+    def __init__(self, size, base_port=5100, node_args=(), log_dir=None):
+        self.ports = list(range(base_port, base_port + size))
+        self.keys = []
+        self.node_args = list(node_args)
+        self.log_dir = log_dir
+        self.__workdirs = []
+        self.__processes = []
+        self.__logs = []
+        self.__session = requests.Session()
+
+    def url(self, port, path):
+        return 'http://localhost:{}/{}'.format(port, path)
+
+    def start(self, timeout=30):
+        """ Start the nodes, create their wallets and make every node a peer of all the others """
+        for port in self.ports:
+            workdir = tempfile.mkdtemp(prefix='blockchain-node-{}-'.format(port))
+            self.__workdirs.append(workdir)
+            log = subprocess.DEVNULL
+            if self.log_dir is not None:
+                os.makedirs(self.log_dir, exist_ok=True)
+                log = open(os.path.join(self.log_dir, 'node-{}.log'.format(port)), mode='w')
+                self.__logs.append(log)
+            self.__processes.append(subprocess.Popen([sys.executable, NODE_SCRIPT, '-p', str(port)] + self.node_args,
+                                                     cwd=workdir, stdout=log, stderr=subprocess.STDOUT))
+        for port in self.ports:
+            self.__wait_until_up(port, timeout)
+        for port in self.ports:
+            response = self.__session.post(self.url(port, 'wallet'))
+            response.raise_for_status()
+            self.keys.append(response.json()['public_key'])
+        for port in self.ports:
+            for peer in self.ports:
+                if peer != port:
+                    self.__session.post(self.url(port, 'node'), json={'node': 'localhost:{}'.format(peer)}).raise_for_status()
+
+    def __wait_until_up(self, port, timeout):
+        deadline = perf_counter() + timeout
+        while True:
+            try:
+                if self.__session.get(self.url(port, 'nodes'), timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            if perf_counter() > deadline:
+                raise RuntimeError('Node on port {} did not start within {}s'.format(port, timeout))
+            sleep(0.1)
+
+    def stop(self):
+        for process in self.__processes:
+            process.terminate()
+        for process in self.__processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in self.__logs:
+            log.close()
+        for workdir in self.__workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.__processes = []
+        self.__workdirs = []
+        self.__logs = []
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def tips(self):
+        """ The hash of every node's last block, None for the nodes which didn't answer """
+        tips = []
+        for port in self.ports:
+            try:
+                tips.append(self.__session.get(self.url(port, 'chain/tip'), timeout=5).json()['hash'])
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                tips.append(None)
+        return tips
+
+
+def percentiles(values):
+    """ Return the count, median, p90, p99 and max of a list of seconds, None for the statistics of an empty list """
+    ordered = sorted(values)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+    return {'count': len(ordered), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': ordered[-1] if ordered else None}
+
+
+def open_loop(rate, duration, send, executor):
+    """ Call send(number, due_time) rate times per second for duration seconds on the executor's threads.
+        Returns the futures; a call that starts late still gets the time it was due """
+    futures = []
+    if rate <= 0:
+        return futures
+    start = perf_counter()
+    number = 0
+    while True:
+        due = start + number / rate
+        if due - start >= duration:
+            return futures
+        delay = due - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        futures.append(executor.submit(send, number, due))
+        number += 1
+
+
+class LoadGenerator:
+    """ Submits transactions and mining jobs to a started Cluster and watches the mempools for the transactions
+
+    Attributes:
+        :cluster: The started Cluster
+        :poll_interval: Seconds between two reads of every node's /transactions
+        :submitted (private): The time each accepted transaction was due, by signature
+        :seen (private): The time each transaction was first seen per node, by signature
+    """
+    def __init__(self, cluster, poll_interval=0.05, max_workers=64):
+        self.cluster = cluster
+        self.poll_interval = poll_interval
+        self.__executor = ThreadPoolExecutor(max_workers)
+        self.__lock = threading.Lock()
+        self.__submitted = {}
+        self.__seen = {}
+        self.__results = {'accepted': 0, 'rejected': 0, 'errors': 0}
+        self.__mine_jobs = []
+        self.__watching = threading.Event()
+
+    def fund(self, blocks_per_node=1):
+        """ Mine blocks on every node in turn so that all wallets have coins to send """
+        for _ in range(blocks_per_node):
+            for port in self.cluster.ports:
+                response = requests.post(self.cluster.url(port, 'mine?wait=true'))
+                if response.status_code != 201:
+                    raise RuntimeError('Funding block on port {} failed: {}'.format(port, response.text))
+
+    def __send_transaction(self, number, due):
+        ports, keys = self.cluster.ports, self.cluster.keys
+        sender = number % len(ports)
+        recipient = keys[(sender + 1) % len(keys)]
+        amount = round(TX_AMOUNT + number * 1e-9, 12)
+        try:
+            response = requests.post(self.cluster.url(ports[sender], 'transaction'), json={'recipient': recipient, 'amount': amount}, timeout=30)
+        except requests.exceptions.RequestException:
+            with self.__lock:
+                self.__results['errors'] += 1
+            return
+        with self.__lock:
+            if response.status_code == 201:
+                self.__results['accepted'] += 1
+                self.__submitted[response.json()['transaction']['signature']] = due
+            else:
+                self.__results['rejected'] += 1
+
+    def __send_mine(self, number, due):
+        port = self.cluster.ports[number % len(self.cluster.ports)]
+        try:
+            response = requests.post(self.cluster.url(port, 'mine'), timeout=30)
+        except requests.exceptions.RequestException:
+            return
+        if response.status_code == 202:
+            with self.__lock:
+                self.__mine_jobs.append((port, response.json()['job_id']))
+
+    def __watch(self):
+        """ Read every node's mempool again and again and note when a transaction shows up at a node """
+        session = requests.Session()
+        while self.__watching.is_set():
+            for port in self.cluster.ports:
+                try:
+                    transactions = session.get(self.cluster.url(port, 'transactions'), timeout=5).json()
+                except (requests.exceptions.RequestException, ValueError):
+                    continue
+                now = perf_counter()
+                with self.__lock:
+                    for tx in transactions:
+                        self.__seen.setdefault(tx['signature'], {}).setdefault(port, now)
+            sleep(self.poll_interval)
+
+    def __wait_for_mining(self, timeout):
+        deadline = perf_counter() + timeout
+        for port, job_id in self.__mine_jobs:
+            while perf_counter() < deadline:
+                try:
+                    job = requests.get(self.cluster.url(port, 'mine/{}'.format(job_id)), timeout=5).json()
+                except (requests.exceptions.RequestException, ValueError):
+                    break
+                if job.get('status') not in ('queued', 'mining'):
+                    break
+                sleep(0.1)
+
+    def converge(self, timeout=60):
+        """ Ask every node to resolve conflicts until all of them have the same tip, return the seconds it took or None """
+        start = perf_counter()
+        while perf_counter() - start < timeout:
+            wait([self.__executor.submit(requests.post, self.cluster.url(port, 'resolve-conflicts'), timeout=30) for port in self.cluster.ports])
+            tips = self.cluster.tips()
+            if None not in tips and len(set(tips)) == 1:
+                return perf_counter() - start
+            sleep(self.poll_interval)
+        return None
+
+    def run(self, duration, tx_rate, mine_rate, drain_timeout=10):
+        """ Drive the load for duration seconds, let the mempools settle and the chains converge, return the report """
+        self.__watching.set()
+        watcher = threading.Thread(target=self.__watch, daemon=True)
+        watcher.start()
+        start = perf_counter()
+        miners = threading.Thread(target=open_loop, args=(mine_rate, duration, self.__send_mine, self.__executor), daemon=True)
+        miners.start()
+        wait(open_loop(tx_rate, duration, self.__send_transaction, self.__executor))
+        elapsed = perf_counter() - start
+        miners.join()
+        # Give the last transactions time to reach every node
+        deadline = perf_counter() + drain_timeout
+        while perf_counter() < deadline and self.__unpropagated():
+            sleep(self.poll_interval)
+        self.__watching.clear()
+        watcher.join()
+        self.__wait_for_mining(drain_timeout + 60)
+        convergence = self.converge()
+
+        with self.__lock:
+            latencies = [max(seen.values()) - self.__submitted[signature] for signature, seen in self.__seen.items()
+                         if signature in self.__submitted and len(seen) == len(self.cluster.ports)]
+            results = dict(self.__results)
+        heights = []
+        for port in self.cluster.ports:
+            try:
+                heights.append(requests.get(self.cluster.url(port, 'chain/tip'), timeout=5).json()['height'])
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                heights.append(None)
+        return {
+            'transactions': {
+                'submitted': sum(results.values()),
+                'accepted': results['accepted'],
+                'rejected': results['rejected'],
+                'errors': results['errors'],
+                'throughput': results['accepted'] / elapsed, # accepted per second
+                'propagation': percentiles(latencies),
+                'not_seen_everywhere': results['accepted'] - len(latencies) # mined before every node's mempool was read, or lost
+            },
+            'mining': {'jobs': len(self.__mine_jobs), 'heights': heights},
+            'convergence': convergence
+        }
+
+    def __unpropagated(self):
+        with self.__lock:
+            return any(len(self.__seen.get(signature, ())) < len(self.cluster.ports) for signature in self.__submitted)
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+
+
+def main():
+    parser = ArgumentParser(prog='python -m benchmarks.cluster')
+    parser.add_argument('--nodes', type=int, default=3, help='number of node processes')
+    parser.add_argument('--base-port', type=int, default=5100, help='port of the first node, the others follow')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--tx-rate', type=float, default=20, help='transactions submitted per second, spread over the nodes')
+    parser.add_argument('--mine-rate', type=float, default=0.2, help='mining jobs started per second, spread over the nodes')
+    parser.add_argument('--fund-blocks', type=int, default=1, help='blocks every node mines before the load so that its wallet has coins')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='seconds between two reads of the mempools')
+    parser.add_argument('--log-dir', help='keep the output of every node in this folder')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('node_args', nargs=REMAINDER, help='arguments for every node.py after --, e.g. -- --difficulty 10')
+    options = parser.parse_args()
+    node_args = options.node_args[1:] if options.node_args[:1] == ['--'] else options.node_args
+
+    with Cluster(options.nodes, options.base_port, node_args, options.log_dir) as cluster:
+        load = LoadGenerator(cluster, options.poll_interval)
+        try:
+            load.fund(options.fund_blocks)
+            results = load.run(options.duration, options.tx_rate, options.mine_rate)
+        finally:
+            load.close()
+
+    report = {
+        'timestamp': time(),
+        'parameters': {key: value for key, value in vars(options).items() if key not in ('output', 'node_args')},
+        'node_args': node_args,
+        'results': results
+    }
+    if options.output:
+        with open(options.output, mode='w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
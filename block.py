@@ -3,9 +3,25 @@ from time import time
 from utility.printable import Printable
 
 class Block(Printable):
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None): # constructor with a default time attribute
+    __slots__ = ('index', 'previous_hash', 'transactions', 'proof', 'timestamp', 'merkle_root', '_hash') # _hash is set once the block is sealed
+
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, merkle_root=None): # constructor with a default time attribute
         self.index = index
         self.previous_hash = previous_hash
         self.transactions = transactions
         self.proof = proof
-        self.timestamp = time() if timestamp is None else timestamp
\ No newline at end of file
+        self.timestamp = time() if timestamp is None else timestamp
+        self.merkle_root = merkle_root # root of the transaction ids, None for blocks mined before it existed
+
+    # The block as a dict with its transactions as dicts, e.g. for JSON
+    def to_dict(self):
+        block = {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'proof': self.proof,
+            'timestamp': self.timestamp
+        }
+        if self.merkle_root is not None: # legacy blocks keep their old form
+            block['merkle_root'] = self.merkle_root
+        return block
@@ -1,103 +1,269 @@
-from functools import reduce
 from collections import OrderedDict
-import json
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import threading
+from time import perf_counter
 
-from utility.hash_util import hash_block
+from utility.broadcast import Broadcaster, TransactionBatcher, TIMEOUT
+from utility.chain_view import ChainView
+from utility.codec import CONTENT_TYPE, decode_blocks, encode_block, encode_transaction, encode_transactions
+from utility.hash_util import hash_block, merkle_root, seal_block
+from utility.lazy_chain import LazyChain
+from utility import metrics
+from utility.pow_engine import ProofOfWorkEngine
+from utility.storage import BINARY, SEGMENT_BLOCKS, Storage
 from block import Block
+from ledger import Ledger
+from address_index import AddressIndex
+from mempool import DROP_OLDEST, Mempool
 from transaction import Transaction
-from utility.verification import Verification
+from utility.verification import DIFFICULTY, Verification
 from wallet import Wallet
 import requests # From Python package. Different from request from Flask package
 
 MINING_REWARD = 10
+CHECKPOINT_INTERVAL = 100 # blocks between two checkpoints of the ledger and the address index
+
+_height = metrics.gauge('blockchain_height', 'Number of blocks in the local chain')
+_open_transactions = metrics.gauge('blockchain_open_transactions', 'Number of open transactions in the mempool')
+_peer_nodes = metrics.gauge('blockchain_peer_nodes', 'Number of peer nodes')
+_hash_rate = metrics.gauge('blockchain_hash_rate', 'Hashes per second of the last proof of work search')
+_block_cache_entries = metrics.gauge('blockchain_block_cache_entries', 'Blocks kept as objects when blocks are loaded on demand, the tail or the cache of older blocks', ('kind',))
+_block_cache_lookups = metrics.gauge('blockchain_block_cache_lookups', 'Lookups of older blocks by whether the block cache had them, since the chain was loaded', ('result',))
+_pow_seconds = metrics.histogram('blockchain_proof_of_work_seconds', 'Time spent searching a proof of work')
+_pow_attempts = metrics.counter('blockchain_proof_of_work_attempts_total', 'Proofs of work tried')
+_mining_restarts = metrics.counter('blockchain_mining_restarts_total', 'Proof of work searches started over because the tip changed')
+_storage_seconds = metrics.histogram('blockchain_storage_seconds', 'Time spent on storage operations, from loading the whole node state to one block append or journal fsync', ('operation',))
+_resolve_seconds = metrics.histogram('blockchain_resolve_seconds', 'Time resolve spends per phase', ('phase',))
+_blocks = metrics.counter('blockchain_blocks_total', 'Blocks mined or received', ('source', 'result'))
+_transactions = metrics.counter('blockchain_transactions_total', 'Transactions submitted or received', ('result',))
 
 class Blockchain:
     """The Blockchain class manages the chain of blocks as well as open transactions and the node on which it's running.
 
     Attributes:
-        :chain: The list of blocks
-        :open_transactions (private): The list of open transactions
+        :chain: A read-only snapshot of the blocks (ChainView), taken in O(1)
+        :lock (private): Held by every change of the chain, open transactions and peer nodes. Readers take snapshots instead
+        :view (private): The snapshot of the current chain, replaced after every change
+        :open_transactions (private): The open transactions, a Mempool indexed by transaction id
         :hosting_node: The connected node (which runs the blockchain).
+        :ledger (private): Per-address running totals backing get_balance
+        :address_index (private): The transactions of every address by block height and position, backing get_address_history
+        :storage (private): The append-only on-disk storage of the node
+        :lazy_load (private): Whether blocks are decoded from the storage on demand instead of all at startup
+        :hot_blocks (private): With lazy_load, the number of most recent blocks kept as objects
+        :block_cache_size (private): With lazy_load, the number of older blocks kept decoded, least recently used go first
+        :pow_engine (private): Runs the proof of work search on one or more processes
+        :difficulty: The leading zero bits a proof of work hash of this chain needs
+        :verify_workers (private): The number of processes checking batches of signatures
+        :broadcaster (private): Sends transactions and blocks to all peer nodes concurrently
+        :async_broadcast (private): Whether broadcasts run in the background instead of the request thread
+        :batcher (private): Coalesces outgoing transactions into batches per peer, disabled with a gossip_window of 0
+        :wire_format (private): BINARY to talk to peers in the format of utility.codec (JSON for peers without it), or JSON
+        :tip_changed (private): Set when a received block or a resolved conflict replaces the tip, cancels a running proof of work
+        :mining_restarts (private): How often the last mine_block started over on a new tip
+        :checkpoint_interval (private): Blocks between two stored checkpoints of the ledger and the address index, 0 turns them off. Startup scans
+            only the blocks (and index log) after the latest checkpoint, a deep fork rolls back to one instead of reverting block by block
     """
-    def __init__(self, public_key, node_id): # node_id to id the node on the Network of Nodes
+    def __init__(self, public_key, node_id, lazy_load=False, pow_workers=1, difficulty=DIFFICULTY, verify_workers=1,
+                 mempool_size=10000, mempool_policy=DROP_OLDEST, peer_timeout=TIMEOUT, async_broadcast=False,
+                 gossip_window=0.05, gossip_batch_size=100, wire_format=BINARY, storage_format=BINARY,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, hot_blocks=100, block_cache_size=256, archive=False): # node_id to id the node on the Network of Nodes
         """The constructor of the Blockchain class."""
-        genesis_block = Block(0, '', [], 100, 0) # Our starting block - which has a dummy proof of work for the blockchain
+        genesis_block = seal_block(Block(0, '', [], 100, 0)) # Our starting block - which has a dummy proof of work for the blockchain
+        self.__lock = threading.RLock()
+        self.__chain_version = 0
         self.chain = [genesis_block] # Initializing our empty blocchain initially using chain property
-        self.__open_transactions = [] # Unhandled transactions, i.e. list of transactions to be added to the blochchain.
+        self.__open_transactions = Mempool(mempool_size, mempool_policy) # Unhandled transactions, i.e. transactions to be added to the blochchain.
         self.public_key = public_key # where a public_key is stored
         self.node_id = node_id
         self.__peer_nodes = set() # set of peer nodes initialized to empty set before loading data from blockchain.txt
         self.resolve_conflicts = False
+        self.__ledger = Ledger()
+        self.__lazy_load = lazy_load or archive # archiving keeps the memory flat only if old blocks aren't held as objects
+        self.__hot_blocks = hot_blocks
+        self.__block_cache_size = block_cache_size
+        self.__pow_engine = ProofOfWorkEngine.shared(pow_workers)
+        self.difficulty = difficulty
+        self.__verify_workers = verify_workers
+        self.__broadcaster = Broadcaster.shared(peer_timeout)
+        self.__async_broadcast = async_broadcast
+        self.__wire_format = wire_format
+        self.__tip_changed = threading.Event()
+        self.__mining_restarts = 0
+        self.__checkpoint_interval = checkpoint_interval
+        self.__batcher = TransactionBatcher(self.__broadcaster, self.get_peer_nodes, gossip_window, gossip_batch_size,
+                                            encode_transactions if wire_format == BINARY else None)
+        # blockchain-<node_id> folder, migrated from blockchain-<node_id>.txt if needed, full segments compressed if archive is set
+        self.__storage = Storage(node_id, storage_format, archive)
+        self.__address_index = AddressIndex(self.__storage)
         self.load_data()
+        self.__publish()
+        # The gauges read the state of the current Blockchain only when the metrics are scraped
+        _height.set_function(self.get_height)
+        _open_transactions.set_function(self.get_open_transactions_count)
+        _peer_nodes.set_function(lambda: len(self.__peer_nodes))
+        _hash_rate.set_function(lambda: self.__pow_engine.last_hash_rate)
+        _block_cache_entries.set_function(lambda: self.__block_cache_samples('entries'))
+        _block_cache_lookups.set_function(lambda: self.__block_cache_samples('lookups'))
+        chain, height = self.__chain, len(self.__chain)
+        # Only time we walk the chain, from the latest checkpoint on, on first balance lookup
+        self.__ledger.rebuild(chain, self.__open_transactions, lambda: self.__find_checkpoint(chain, height))
+        # Loads the index of the checkpoint and the stored log after it on first use, scanning only the blocks it misses
+        self.__address_index.rebuild(chain, lambda: self.__find_checkpoint(chain, height))
 
      # This turns the chain attribute into a property with a getter (the method below) and a setter (@chain.setter)
     @property
     def chain(self):
-        return self.__chain[:] # retun a copy
+        return self.__view # a snapshot instead of a copy, blocks added later are not part of it
 
     # The setter for the chain property
     @chain.setter
     def chain(self, val):
-        self.__chain = val # pass # to avoid changing that property
-    
+        with self.__lock:
+            self.__chain = val # pass # to avoid changing that property
+            self.__publish()
+
+    def __publish(self):
+        """ Replace the snapshot readers get after the chain changed. The chain is only ever appended to
+            or replaced by a new sequence, so a snapshot stays valid without copying anything """
+        self.__chain_version += 1
+        self.__view = ChainView(self.__chain, len(self.__chain), self.__chain_version)
+
+    def get_height(self):
+        """ Return the number of blocks """
+        return len(self.__view)
+
+    def get_address_history(self, address, cursor=None, limit=50):
+        """ Return one page of the transactions an address sent or received, newest first
+
+        Arguments:
+            :cursor: The (height, position) the previous page ended with, None for the first page
+            :limit: The maximum number of transactions of the page
+        Returns:
+            (list of dicts with the block height, timestamp, position, role and transaction, cursor of the next page or None)
+        """
+        chain_view = self.__view # entries of blocks appended meanwhile are left out, their blocks aren't in the snapshot
+        page, next_cursor = self.__address_index.history(address, cursor, limit, len(chain_view))
+        history = []
+        for height, position, role in page:
+            block = chain_view[height]
+            history.append({'height': height, 'timestamp': block.timestamp, 'position': position, 'role': role,
+                            'transaction': block.transactions[position].to_dict()})
+        return history, next_cursor
+
+    def get_open_transactions_count(self):
+        return len(self.__open_transactions)
+
     def get_open_transactions(self):
-        return self.__open_transactions[:]
+        return self.__open_transactions.transactions()
+
+    def has_open_transaction(self, recipient, sender, signature, amount):
+        """ Check whether the very same transaction is already waiting to be mined, it can't be added twice """
+        return Transaction(sender, recipient, signature, amount).id in self.__open_transactions
 
-    # pickle is better than json: Override blockchain & open_transactions wouldn't have been necessary with picke
     def load_data(self):
-        """ Initialize blockchain + open transactions data as OrderedDict from blockchain.txt then deserialize them 
-            to Python object and load them to memory """
+        """ Load the blocks, open transactions and peer nodes from the storage folder then deserialize them
+            to Python objects and load them to memory """
+        start = perf_counter()
         try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='r') as f:
-                file_content = f.readlines()
-                blockchain = json.loads(file_content[0][:-1])  # take the first line without \n
-                # Transaction from Blockchain we loaded from blockchain.txt as a OrderDict
-                updated_blockchain = []
-                for block in blockchain:
-                    converted_tx = [Transaction(tx["sender"], tx["recipient"], tx['signature'], tx["amount"]) for tx in block['transactions']]
-                    updated_block = Block(block['index'], block['previous_hash'], converted_tx, block['proof'], block['timestamp'])
-                
-                    updated_blockchain.append(updated_block)
-                self.__chain = updated_blockchain
-                open_transactions = json.loads(file_content[1][:-1])  # Take 2nd line without \n
-                # Open_transaction should be as OrderDict as well
-                updated_transactions = []
-                for tx in open_transactions:
-                    updated_transaction = Transaction(tx["sender"], tx["recipient"], tx['signature'], tx["amount"])
-                    updated_transactions.append(updated_transaction)
-                self.__open_transactions = updated_transactions
-                peer_nodes = json.loads(file_content[2])
-                self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError):  # to handle file not found & empty file errors
-            print('Handled exceptions: FNF & File empty ...')
+            if self.__storage.height == 0:
+                self.__storage.append_block(self.__chain[0].to_dict()) # a new block log starts with the genesis block
+            if self.__lazy_load:
+                # Only the tip gets decoded now, the other blocks when something reads them
+                self.__chain = self.__lazy_chain()
+            else:
+                # Transaction from Blockchain we loaded as a OrderDict
+                self.__chain = [self.__block_from_dict(block) for block in self.__storage.load_blocks()]
+            # Replay the journal: transactions get added, 'removed' records take them out again
+            for record in self.__storage.load_open_transactions():
+                if 'removed' in record:
+                    for tx_id in record['removed']:
+                        self.__open_transactions.remove(tx_id)
+                else:
+                    self.__open_transactions.add(Transaction(record["sender"], record["recipient"], record['signature'], record["amount"]))
+            self.__peer_nodes = set(self.__storage.load_peer_nodes())
+        except (IOError, KeyError):  # to handle unreadable files
+            print('Handled exceptions: loading data failed ...')
         finally:
+            _storage_seconds.observe(perf_counter() - start, operation='load_data')
             print("Cleanup!")
 
     def save_data(self):
-        """Write to dynamic file and let python close the file by using 'with' statetemnt"""
-        try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='w') as f:
-                saveable_chain = [block.__dict__ for block in [Block(block_el.index, block_el.previous_hash, [tx.__dict__ for tx in block_el.transactions], block_el.proof, block_el.timestamp) for block_el in self.__chain]]
-                f.write(json.dumps(saveable_chain))
-                f.write('\n')
-                saveable_tx = [tx.__dict__ for tx in self.__open_transactions]
-                f.write(json.dumps(saveable_tx))
-                f.write('\n')
-                f.write(json.dumps(list(self.__peer_nodes)))
-        except IOError:
-            print('Saving to file failed!')
-
-    def proof_of_work(self):
-        """Generate PoW number as the check of stored hash == previous hash is not enough"""
-        proof = 0
+        """ Write a full snapshot of blocks, open transactions and peer nodes. The regular code paths only
+            append what changed, this is for when everything has to be rewritten """
+        with self.__lock, _storage_seconds.time(operation='save_data'):
+            self.__storage.replace_blocks([block.to_dict() for block in self.__chain])
+            self.__storage.write_open_transactions([tx.to_dict() for tx in self.__open_transactions.transactions()])
+            self.__storage.write_peer_nodes(self.__peer_nodes)
+
+    def __find_checkpoint(self, chain, max_height):
+        """ Return the latest stored checkpoint at or below a height which belongs to the given chain, None if there is none """
+        for height in self.__storage.checkpoint_heights():
+            if height > max_height or height > len(chain):
+                continue
+            checkpoint = self.__storage.read_checkpoint(height)
+            if checkpoint is not None and checkpoint.get('hash') == hash_block(chain[height - 1]):
+                return checkpoint
+        return None
+
+    def __write_checkpoint(self, previous_height):
+        """ Store a checkpoint of the ledger if the chain grew past a multiple of the checkpoint interval since previous_height """
+        height = len(self.__chain)
+        if not self.__checkpoint_interval or height // self.__checkpoint_interval <= previous_height // self.__checkpoint_interval:
+            return
+        checkpoint = self.__ledger.snapshot()
+        checkpoint['addresses'] = self.__address_index.snapshot()
+        checkpoint['height'] = height
+        checkpoint['hash'] = hash_block(self.__chain[-1])
+        self.__storage.write_checkpoint(checkpoint)
+
+    def __lazy_chain(self):
+        return LazyChain(self.__storage, self.__block_from_dict, self.__hot_blocks, self.__block_cache_size)
+
+    def get_block_cache_stats(self):
+        """ Return the blocks kept as objects and the block cache counters, None unless blocks are loaded on demand """
+        chain = self.__chain
+        return chain.cache_stats() if isinstance(chain, LazyChain) else None
+
+    def __block_cache_samples(self, kind):
+        """ Return the values of a block cache gauge by label values, none unless blocks are loaded on demand """
+        stats = self.get_block_cache_stats()
+        if stats is None:
+            return {}
+        if kind == 'entries':
+            return {('tail',): stats['tail'], ('cache',): stats['cache']['size']}
+        return {('hit',): stats['cache']['hits'], ('miss',): stats['cache']['misses']}
+
+    @staticmethod
+    def __block_from_dict(block):
+        """ Convert a block dict (e.g. from storage) into a block object with transaction objects """
+        converted_tx = [Transaction(tx["sender"], tx["recipient"], tx['signature'], tx["amount"]) for tx in block['transactions']]
+        if type(block['previous_hash']) is not str or not all(type(text) is str for tx in converted_tx for text in (tx.sender, tx.recipient, tx.signature)):
+            raise ValueError('Malformed block, texts expected') # the block formats hold nothing else
+        return seal_block(Block(block['index'], block['previous_hash'], converted_tx, block['proof'], block['timestamp'], block.get('merkle_root'))) # its hash is computed once
+
+    def proof_of_work(self, merkle_root=None):
+        """Generate PoW number as the check of stored hash == previous hash is not enough.
+           Covers the Merkle root of the new block's transactions if given, else the open transactions"""
         last_block = self.__chain[-1]
         last_hash = hash_block(last_block)
 
-        # Try different PoW numbers and return the first valid one
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
-            proof += 1
+        # Try different PoW numbers (split across the workers of the engine) and return a valid one, None if the tip changed meanwhile
+        with _pow_seconds.time():
+            proof = self.__pow_engine.search(self.__open_transactions.transactions(), last_hash, self.difficulty, merkle_root, self.__tip_changed)
+        _pow_attempts.inc(self.__pow_engine.last_attempts)
         return proof
 
+    def get_mining_stats(self):
+        """ Return the workers, proofs tried and hashes per second of the last (or the running) proof of work """
+        return {
+            'workers': self.__pow_engine.workers,
+            'attempts': self.__pow_engine.last_attempts,
+            'hash_rate': self.__pow_engine.last_hash_rate,
+            'restarts': self.__mining_restarts,
+            'searching': self.__pow_engine.searching
+        }
+
     def get_balance(self, sender=None):
         """ Calculate and return the balance for a particiapant """
         if sender == None:
@@ -106,30 +272,14 @@ class Blockchain:
             participant = self.public_key # The node, i.e. the host will always sends the money
         else:
             participant = sender
-        tx_sender = [[tx.amount for tx in block.transactions if tx.sender == participant] for block in self.__chain]
-        open_tx_sender = [tx.amount for tx in self.__open_transactions if tx.sender == participant]
-        tx_sender.append(open_tx_sender)  # add open transaction to tx_sender as well to prevent a sender from sending globally more than he has
-        print(tx_sender)  # to debug *************************
-        amount_sent = reduce(
-            lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0,
-            tx_sender,
-            0,
-        )  
-        # This fetches received coin amounts of transactions that were already included in blocks of the blockchain
-        # We ignore open transactions here because you shouldn't be able to spend coins before the transaction was confirmed + included in a block
-        tx_recipient = [[tx.amount for tx in block.transactions if tx.recipient == participant] for block in self.__chain]
-        amount_received = reduce(
-            lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0,
-            tx_recipient,
-            0,
-        )
-        return amount_received - amount_sent
+        return self.__ledger.balance(participant)
 
     def get_last_blockchain_value(self):
-        """Returns the last value of the current blockchain."""
-        if len(self.__chain) < 1:
+        """Returns the last value of the current blockchain (the tip)."""
+        view = self.__view
+        if len(view) < 1:
             return None
-        return self.__chain[-1]
+        return view.tip
 
     def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False):
         """Append a new value and the last blockchain value to the blockchain.
@@ -144,119 +294,369 @@ class Blockchain:
         #     return False
         # Creating a transaction object
         transaction = Transaction(sender, recipient, signature, amount)
-       
-        if Verification.verify_transaction(transaction, self.get_balance): # a ref to func get_balance
-            self.__open_transactions.append(transaction)
-            self.save_data()  # write to blockchain.txt
+        if not Verification.valid_transaction_fields(sender, recipient, signature, amount) or not Verification.valid_amount(amount):
+            print('Transaction needs texts for its keys and signature and a positive amount.')
+            _transactions.inc(result='rejected')
+            return False
+        if transaction.id in self.__open_transactions:
+            return False # already pending, e.g. the same broadcast twice
+        if not Verification.verify_transaction(transaction, self.get_balance, check_funds=False): # the slow part, outside the lock
+            return False
+        journal_records = []
+        with self.__lock:
+            # Checked again under the lock so that two transactions can't spend the same funds
+            admitted = (
+                transaction.id not in self.__open_transactions
+                and self.get_balance(transaction.sender) >= transaction.amount
+                and self.__admit(transaction, journal_records)
+            )
+        self.__storage.sync_journal(max(journal_records, default=None))
+        _transactions.inc(result='accepted' if admitted else 'rejected')
+
+        if admitted:
             # Broadcasting to the network by sending an http request iff we are on the node where that tx has been originally created
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-transaction'.format(node)
-                    try:
-                        response = requests.post(url, json={'sender': sender, 'recipient': recipient, 'signature': signature, 'amount': amount})
-                        if response.status_code == 400 or response.status_code == 500:
+            # Without peers there is nobody to tell: no batch window to wait for, no payload to encode
+            if not is_receiving and self.__peer_nodes:
+                payload = {'sender': sender, 'recipient': recipient, 'signature': signature, 'amount': amount}
+                if self.__batcher.window > 0:
+                    # Coalesced with the other transactions of the next few milliseconds into one request per peer
+                    accepted = self.__batcher.submit(payload)
+                    if self.__async_broadcast:
+                        accepted.add_done_callback(lambda future: future.result() or print('Transaction declined, needs resolving.'))
+                    else:
+                        try:
+                            # The window, then the request, its JSON retry and the one by one fallback of an older peer
+                            broadcasted = accepted.result(timeout=self.__batcher.window + 3 * self.__broadcaster.timeout)
+                        except FutureTimeoutError:
+                            print('Broadcasting the transaction timed out.')
+                            return False
+                        if not broadcasted:
                             print('Transaction declined, needs resolving.')
                             return False
-                    except requests.exceptions.ConnectionError:
-                        continue # skip a node if it's down
+                else:
+                    data = self.__encode(encode_transaction, payload)
+                    if self.__async_broadcast:
+                        self.__broadcaster.post_all_async(self.__peer_nodes, 'broadcast-transaction', payload, self.__transaction_broadcasted, data)
+                    elif not self.__transaction_broadcasted(self.__broadcaster.post_all(self.__peer_nodes, 'broadcast-transaction', payload, data)):
+                        return False
             return True
         return False
 
+    def add_transactions(self, transactions, is_receiving=True):
+        """Add a batch of transactions, checking all their signatures in one pass.
+
+        Arguments:
+        :transactions: The transactions as dicts with sender, recipient, signature and amount.
+        :is_receiving: False for transactions created on this node, the accepted ones are then broadcast in one request per peer
+        Returns:
+            A list with True or False per transaction, a bad one doesn't affect the others
+        """
+        converted_tx = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in transactions]
+        signatures_valid = Wallet.verify_tx_signatures(converted_tx, self.__verify_workers)
+        results = []
+        journal_records = []
+        try:
+            with self.__lock:
+                for transaction, signature_valid in zip(converted_tx, signatures_valid):
+                    accepted = (
+                        signature_valid
+                        # a malformed item only declines its own transaction
+                        and Verification.valid_transaction_fields(transaction.sender, transaction.recipient, transaction.signature, transaction.amount)
+                        and Verification.valid_amount(transaction.amount)
+                        and transaction.id not in self.__open_transactions
+                        and self.get_balance(transaction.sender) >= transaction.amount # includes the batch's earlier transactions
+                        and self.__admit(transaction, journal_records)
+                    )
+                    results.append(accepted)
+                    _transactions.inc(result='accepted' if accepted else 'rejected')
+        finally:
+            self.__storage.sync_journal(max(journal_records, default=None)) # one fsync for the batch, outside the lock
+
+        admitted = [tx for tx, accepted in zip(transactions, results) if accepted]
+        if not is_receiving and admitted and self.__peer_nodes:
+            payload = [{'sender': tx['sender'], 'recipient': tx['recipient'], 'signature': tx['signature'], 'amount': tx['amount']} for tx in admitted]
+            if self.__async_broadcast:
+                threading.Thread(target=self.__transactions_broadcasted, args=(payload,), daemon=True).start()
+            else:
+                broadcasted = iter(self.__transactions_broadcasted(payload))
+                results = [accepted and next(broadcasted) for accepted in results] # one answer per admitted transaction
+        return results
+
+    def __transactions_broadcasted(self, payload):
+        """ Send our own transactions to every peer at once, return True or False per transaction whether all peers took it """
+        accepted = self.__batcher.send(payload)
+        if not all(accepted):
+            print('Transaction declined, needs resolving.')
+        return accepted
+
+    def __admit(self, transaction, journal_records):
+        """ Put a verified transaction into the mempool, ledger and journal. Returns False if the mempool refused it.
+            Called with the lock held, the journal records to sync once it's released get appended to journal_records """
+        added, evicted = self.__open_transactions.add(transaction)
+        if not added:
+            print('Mempool is full, transaction declined.')
+            return False
+        for tx in evicted:
+            self.__ledger.remove_pending(tx)
+        journal_records.append(self.__storage.remove_open_transactions([tx.id for tx in evicted], sync=False))
+        self.__ledger.add_pending(transaction)
+        journal_records.append(self.__storage.append_open_transaction(transaction.to_dict(), sync=False)) # only journal the new transaction
+        journal_records[:] = [record for record in journal_records if record is not None]
+        return True
+
     def mine_block(self):
         """Create a new block and add a copy of open transactions to it."""
         # Fetch the currently last block of the blockchain
         # Without a public_key we can't mine
         if self.public_key == None:
             return None #return False
-        
-        last_block = self.__chain[-1]
-        hashed_block = hash_block(last_block)  # hash the last block to compare it to the stored hash value
-        proof = self.proof_of_work()  # gen a proof of work number
-
-        reward_transaction = Transaction("MINING", self.public_key, '', MINING_REWARD) # An unsigned mining transaction
-
-        # Copy transaction instead of manipulating the original open_transactions list
-        # This ensures that if for some reason the mining should fail, we don't have the reward transaction stored in the open transactions
-        copied_transactions = self.__open_transactions[:]
-        # Signatrue check for every single transaction in the block before appending the reward transaction
-        for tx in copied_transactions:
-            if not Wallet.verify_tx_signature(tx):
-                return None # return False # As bonus, if false we should also remove that tx
-        copied_transactions.append(reward_transaction)
-        block = Block(len(self.__chain), hashed_block, copied_transactions, proof)
-
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-            converted_block = block.__dict__.copy()
-            converted_block['transactions'] = [tx.__dict__ for tx in converted_block['transactions']]
-            try:
-                response = requests.post(url, json={'block': converted_block})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined, needs resolving.')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True # Conflict
-            except requests.exceptions.ConnectionError:
-                continue # if any connection issue
+
+        self.__mining_restarts = 0
+        while True:
+            with self.__lock:
+                self.__tip_changed.clear() # a block arriving from now on cancels this round
+                last_block = self.__chain[-1]
+            hashed_block = hash_block(last_block)  # hash the last block to compare it to the stored hash value
+            # Signature check for every single transaction before the proof of work, which has to cover exactly the block's transactions
+            self.__drop_invalid_transactions()
+
+            reward_transaction = Transaction("MINING", self.public_key, '', MINING_REWARD) # An unsigned mining transaction
+
+            # Copy transaction instead of manipulating the original open_transactions list
+            # This ensures that if for some reason the mining should fail, we don't have the reward transaction stored in the open transactions
+            copied_transactions = self.__open_transactions.transactions()
+            copied_transactions.append(reward_transaction)
+            # The proof of work and the block hash cover the Merkle root of all transactions, the reward included
+            root = merkle_root([tx.id for tx in copied_transactions])
+            proof = self.proof_of_work(root)  # gen a proof of work number, without holding the lock
+            with self.__lock:
+                if proof is not None and not self.__tip_changed.is_set():
+                    block = seal_block(Block(len(self.__chain), hashed_block, copied_transactions, proof, merkle_root=root))
+                    converted_block = block.to_dict()
+                    # Stored first: a block the storage refuses leaves the chain, ledger and pool as they were
+                    if not self.__storage.append_block(converted_block):
+                        _blocks.inc(source='mined', result='rejected')
+                        return None
+                    self.__chain.append(block)
+                    self.__publish()
+                    # Only the mined transactions leave the pool, the ones which arrived during the proof of work stay
+                    for tx in copied_transactions[:-1]:
+                        if self.__open_transactions.remove(tx.id) is not None:
+                            self.__ledger.remove_pending(tx)
+                    self.__ledger.apply_block(block)
+                    self.__address_index.apply_block(block)
+                    self.__write_checkpoint(block.index)
+                    self.__storage.write_open_transactions([tx.to_dict() for tx in self.__open_transactions.transactions()])
+                    _blocks.inc(source='mined', result='accepted')
+                    break
+            # A peer's block or a resolved conflict replaced our tip, the proof would be stale: start over on the new tip
+            self.__mining_restarts += 1
+            _mining_restarts.inc()
+        data = self.__encode(encode_block, converted_block)
+        if self.__async_broadcast:
+            self.__broadcaster.post_all_async(self.__peer_nodes, 'broadcast-block', {'block': converted_block}, self.__block_broadcasted, data)
+        else:
+            self.__block_broadcasted(self.__broadcaster.post_all(self.__peer_nodes, 'broadcast-block', {'block': converted_block}, data))
         return block # return the block either True of False
+
+    def __encode(self, encode, payload):
+        """ Return the binary form of an outgoing payload, None when peers get JSON only """
+        return encode(payload) if self.__wire_format == BINARY else None
+
+    @staticmethod
+    def __transaction_broadcasted(statuses):
+        """ Return False if any peer declined the transaction, unreachable peers are skipped """
+        if any(status == 400 or status == 500 for status in statuses.values()):
+            print('Transaction declined, needs resolving.')
+            return False
+        return True
+
+    def __block_broadcasted(self, statuses):
+        """ Flag a conflict if any peer answered 409, unreachable peers are skipped """
+        for status in statuses.values():
+            if status == 400 or status == 500:
+                print('Block declined, needs resolving.')
+            if status == 409:
+                self.resolve_conflicts = True # Conflict
    
+    def __drop_invalid_transactions(self):
+        """ Verify the signatures of all open transactions as one batch and remove the invalid ones
+            instead of failing the whole mining """
+        open_transactions = self.__open_transactions.transactions()
+        results = Wallet.verify_tx_signatures(open_transactions, self.__verify_workers)
+        invalid_ids = []
+        with self.__lock:
+            for tx, valid in zip(open_transactions, results):
+                valid = valid and Verification.valid_transaction_fields(tx.sender, tx.recipient, tx.signature, tx.amount) # e.g. journaled by an older version
+                if not valid and self.__open_transactions.remove(tx.id) is not None:
+                    print('Dropping transaction with an invalid signature.')
+                    self.__ledger.remove_pending(tx)
+                    invalid_ids.append(tx.id)
+            record = self.__storage.remove_open_transactions(invalid_ids, sync=False)
+        self.__storage.sync_journal(record)
+
    # Add a Block instead of mine_block
     def add_block(self, block):
         """Add a block which was received via broadcasting to the local blockchain."""
         # From list of dict_block to list of object_block
-        transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-        # Validate the proof of work of the block and store the result (True or False) in a variable
-        proof_is_valid = Verification.valid_proof(transactions[:-1], block['previous_hash'], block['proof']) # transaction[:-1] to exclude mining_tx
-        # Check if previous_hash stored in the block is equal to the local blockchain's last block's hash and store the result in a block
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
-        if not proof_is_valid or not hashes_match:
+        try:
+            converted_block = self.__block_from_dict(block)
+        except (ValueError, KeyError, TypeError):
+            print('Received block is malformed.')
+            _blocks.inc(source='received', result='rejected')
             return False
-        # Create a Block object
-        converted_block = Block(block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
-        self.__chain.append(converted_block)
-        stored_transactions = self.__open_transactions[:]
-
-        # Check which open transactions were included in the received block and remove them
-        # This could be improved by giving each transaction an ID that would uniquely identify it
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
-                    try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed.')
-        self.save_data()
+        transactions = converted_block.transactions
+        # Validate the proof of work of the block (and its Merkle root) and store the result (True or False) in a variable
+        proof_is_valid = Verification.valid_block_proof(converted_block, self.difficulty)
+        # Signatures checked as one batch outside the lock, the ones verified at admission are cache hits
+        if not proof_is_valid or not self.__valid_signatures([converted_block]):
+            _blocks.inc(source='received', result='rejected')
+            return False
+        with self.__lock:
+            # Check if previous_hash stored in the block is equal to the local blockchain's last block's hash and store the result in a block
+            hashes_match = hash_block(self.__chain[-1]) == block['previous_hash']
+            if not hashes_match or converted_block.index != len(self.__chain): # the index has to be the block's height
+                _blocks.inc(source='received', result='rejected')
+                return False
+            # Stored first: a block the storage refuses leaves the chain and the ledger as they were
+            if not self.__storage.append_block(converted_block.to_dict()):
+                _blocks.inc(source='received', result='rejected')
+                return False
+            self.__chain.append(converted_block)
+            self.__publish()
+            self.__tip_changed.set()
+            self.__ledger.apply_block(converted_block)
+            self.__address_index.apply_block(converted_block)
+            self.__write_checkpoint(converted_block.index)
+
+            # Remove the open transactions which were included in the received block, one lookup by id each
+            removed_ids = []
+            for tx in transactions:
+                removed = self.__open_transactions.remove(tx.id)
+                if removed is not None:
+                    self.__ledger.remove_pending(removed)
+                    removed_ids.append(tx.id)
+            record = self.__storage.remove_open_transactions(removed_ids, sync=False)
+        self.__storage.sync_journal(record)
+        _blocks.inc(source='received', result='accepted')
         return True
     
     # Resolve conflicts return True or False
     def resolve(self):
-        """Checks all peer nodes' blockchains and replaces the local one with longer valid ones."""
-        winner_chain = self.chain
-        replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        """Checks the tips of all peer nodes and replaces the local chain with the longest valid one.
+           Only the blocks after the fork point get downloaded and validated."""
+        local_chain = self.chain
+        local_height = len(local_chain)
+        # Ask all peers for their height at once, only longer chains are candidates, longest first
+        with _resolve_seconds.time(phase='tips'):
+            tips = self.__broadcaster.get_all_json(self.__peer_nodes, 'chain/tip')
+        candidates = sorted(((tip['height'], node) for node, tip in tips.items() if isinstance(tip, dict) and tip.get('height', 0) > local_height), reverse=True)
+        winner = None
+        for peer_height, node in candidates:
             try:
-                response= requests.get(url) # Send a request and store the response
-                node_chain = response.json() # Retrieve the JSON data as a dictionary
-                # Convert the dictionary list to a list of block AND transaction objects
-                node_chain = [Block(block['index'], block['previous_hash'], [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], block['proof'], block['timestamp']) for block in node_chain]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-                # Store the received chain as the current winner chain if it's longer AND valid
-                if node_chain_length > local_chain_length and Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
+                with _resolve_seconds.time(phase='download'):
+                    fork, suffix = self.__fetch_divergent_blocks(node, local_chain)
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
                 continue
-        self.resolve_conflicts = False # Conflict solved at this point
-        # Replace the local chain with the winner chain
-        self.chain = winner_chain
-        if replace:
-            self.__open_transactions = []
-        self.save_data()
-        return replace
+            # Store the received blocks as the winner if they make a longer chain AND are valid on top of our block before the fork.
+            # That block is trusted, without one (fork 0) the peer's chain doesn't share our genesis block
+            anchor = [local_chain[fork - 1]] if fork > 0 else []
+            with _resolve_seconds.time(phase='verify'):
+                valid = (
+                    fork + len(suffix) > local_height
+                    and Verification.verify_chain(anchor + suffix, self.difficulty, trusted_height=len(anchor))
+                    and self.__valid_signatures(suffix)
+                )
+            if valid:
+                winner = (fork, suffix)
+                break
+        with self.__lock, _resolve_seconds.time(phase='replace'):
+            self.resolve_conflicts = False # Conflict solved at this point
+            if winner is None:
+                return False
+            fork, suffix = winner
+            current_height = len(self.__chain)
+            if self.__chain_version != local_chain.version:
+                # Blocks arrived during the download, the winner has to still fit on our block before the fork and be longer
+                if fork > current_height or fork + len(suffix) <= current_height or (fork > 0 and hash_block(self.__chain[fork - 1]) != hash_block(local_chain[fork - 1])):
+                    self.resolve_conflicts = True # try again with the new chain
+                    return False
+            # Replace the local blocks after the fork with the winner's. A fork deeper than the checkpoint interval
+            # rolls the ledger back to the checkpoint below it, at most an interval of blocks to apply again.
+            # One below the kept checkpoints recomputes the ledger from the genesis block instead
+            rolled_back = False
+            if self.__checkpoint_interval and current_height - fork > self.__checkpoint_interval:
+                checkpoint = self.__find_checkpoint(self.__chain, fork)
+                if checkpoint is None:
+                    print('Fork below the kept checkpoints, rebuilding the ledger from the chain.')
+                self.__ledger.restore(checkpoint, [self.__chain[index] for index in range(checkpoint['height'] if checkpoint else 0, fork)])
+                rolled_back = True
+            for index in range(fork, current_height):
+                if not rolled_back:
+                    self.__ledger.revert_block(self.__chain[index])
+                self.__address_index.revert_block(self.__chain[index]) # pops the entries of the block, whatever the depth
+            self.__storage.drop_checkpoints(fork)
+            if self.__lazy_load:
+                # Snapshots of the old chain read it from the storage, they keep the replaced blocks as objects instead.
+                # The rest of its segment is written again unchanged, so from its start on
+                self.__chain.detach(fork // SEGMENT_BLOCKS * SEGMENT_BLOCKS)
+            self.__storage.replace_blocks([block.to_dict() for block in suffix], fork)
+            if self.__lazy_load:
+                self.__chain = self.__lazy_chain()
+            else:
+                self.__chain = self.__chain[:fork] + suffix
+            self.__publish()
+            self.__tip_changed.set()
+            for block in suffix:
+                self.__ledger.apply_block(block)
+                self.__address_index.apply_block(block)
+            self.__write_checkpoint(fork)
+            self.__open_transactions.clear()
+            self.__ledger.clear_pending()
+            self.__storage.write_open_transactions([])
+        return True
+
+    def __fetch_divergent_blocks(self, node, local_chain):
+        """ Download a peer's blocks from the first one which differs from ours.
+            Starts at our tip and steps back twice as far each time the downloaded blocks don't link to ours.
+
+        Returns:
+            (fork height, the peer's blocks from the fork height on)
+        """
+        local_height = len(local_chain)
+        start = local_height
+        step = 1
+        blocks = []
+        while True:
+            # Fetch only the part before what we already downloaded
+            params = {'from': start, 'to': fetched_from} if blocks else {'from': start}
+            if self.__wire_format == BINARY:
+                response = self.__broadcaster.get(node, 'chain', params=params, headers={'Accept': '{}, application/json'.format(CONTENT_TYPE)})
+            else:
+                response = self.__broadcaster.get(node, 'chain', params=params)
+            if response.headers.get('Content-Type', '').startswith(CONTENT_TYPE): # older peers answer with JSON anyway
+                dict_blocks = decode_blocks(response.content)
+            else:
+                dict_blocks = response.json()
+            blocks = [self.__block_from_dict(block) for block in dict_blocks] + blocks
+            fetched_from = start
+            if start == 0 or (blocks and blocks[0].previous_hash == hash_block(local_chain[start - 1])):
+                break
+            start = max(0, local_height - step)
+            step *= 2
+        # Skip the downloaded blocks we have as well
+        fork = start
+        while fork < local_height and fork - start < len(blocks) and hash_block(blocks[fork - start]) == hash_block(local_chain[fork]):
+            fork += 1
+        return fork, blocks[fork - start:]
+
+    def __valid_signatures(self, chain):
+        """ Check the signatures of all transactions of a chain except the mining rewards, as one batch """
+        if any(not block.transactions or block.transactions[-1].sender != 'MINING' for block in chain):
+            print('Block without a mining reward as its last transaction.')
+            return False # else the unchecked last transaction could be anyone's
+        signed_transactions = [tx for block in chain for tx in block.transactions[:-1]]
+        return all(Wallet.verify_tx_signatures(signed_transactions, self.__verify_workers))
 
    # Peer Nodes 
     def add_peer_node(self, node):
@@ -265,8 +665,9 @@ class Blockchain:
         Arguments:
            :node: The node URL which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes = self.__peer_nodes | {node} # a new set, broadcasts may be iterating over the old one
+            self.__storage.write_peer_nodes(self.__peer_nodes)
 
     def remove_peer_node(self, node):
         """ Remove a node from the peer node set if it's there
@@ -274,8 +675,9 @@ class Blockchain:
         Arguments:
            :node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node) # remove if it exists
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes = self.__peer_nodes - {node} # remove if it exists
+            self.__storage.write_peer_nodes(self.__peer_nodes)
 
     def get_peer_nodes(self):
         """ Return a list of all connected peer nodes """
@@ -0,0 +1,111 @@
+import threading
+
+
+class Ledger:
+    """ Keeps running per-address totals so a balance lookup doesn't have to scan the whole chain.
+
+    Attributes:
+        :sent (private): Confirmed amounts sent per address (transactions already in blocks)
+        :received (private): Confirmed amounts received per address
+        :pending (private): Outgoing amounts per address from open transactions
+        :source (private): The chain, open transactions and checkpoint loader to recompute the totals from on first use
+        :build_lock (private): Readers arriving during that first computation wait for it instead of seeing partial totals
+    """
+    def __init__(self):
+        self.__sent = {}
+        self.__received = {}
+        self.__pending = {}
+        self.__source = None
+        self.__build_lock = threading.Lock()
+
+    def rebuild(self, chain, open_transactions, load_checkpoint=None):
+        """ Recompute every total, only needed when a whole chain is loaded or replaced.
+            The scan is deferred to the first use so that a node can start serving right away
+
+        Arguments:
+            :load_checkpoint: Optional function returning a checkpoint (see snapshot) of this chain or None,
+                only the blocks after the checkpoint get scanned then
+        """
+        self.__source = (chain, len(chain), list(open_transactions), load_checkpoint)
+
+    def __ensure_built(self):
+        if self.__source is None:
+            return
+        with self.__build_lock:
+            if self.__source is None: # built by another thread meanwhile
+                return
+            chain, height, open_transactions, load_checkpoint = self.__source
+            checkpoint = load_checkpoint() if load_checkpoint is not None else None
+            self.__load(checkpoint)
+            for index in range(checkpoint['height'] if checkpoint else 0, height):
+                self.__apply(chain[index])
+            self.__pending = {}
+            for tx in open_transactions:
+                self.__pending[tx.sender] = self.__pending.get(tx.sender, 0) + tx.amount
+            self.__source = None # only now the totals are complete
+
+    def __load(self, checkpoint):
+        self.__sent = dict(checkpoint['sent']) if checkpoint else {}
+        self.__received = dict(checkpoint['received']) if checkpoint else {}
+
+    def snapshot(self):
+        """ Return the confirmed totals as a checkpoint dict, the caller adds the 'height' and 'hash' of the block they match """
+        self.__ensure_built()
+        return {'sent': dict(self.__sent), 'received': dict(self.__received)}
+
+    def restore(self, checkpoint, blocks):
+        """ Reset the confirmed totals to a checkpoint then apply the blocks which followed it, e.g. to roll back a
+            deep fork in a bounded number of blocks instead of reverting every replaced block. Pending amounts are kept """
+        with self.__build_lock:
+            if self.__source is not None: # not built yet, only the pending amounts are needed from the source
+                self.__pending = {}
+                for tx in self.__source[2]:
+                    self.__pending[tx.sender] = self.__pending.get(tx.sender, 0) + tx.amount
+            self.__load(checkpoint)
+            for block in blocks:
+                self.__apply(block)
+            self.__source = None
+
+    def apply_block(self, block):
+        """ Add the transactions of a newly appended block to the confirmed totals """
+        self.__ensure_built()
+        self.__apply(block)
+
+    def revert_block(self, block):
+        """ Take the transactions of a block which gets replaced (fork) out of the confirmed totals again """
+        self.__ensure_built()
+        for tx in block.transactions:
+            self.__sent[tx.sender] = self.__sent.get(tx.sender, 0) - tx.amount
+            self.__received[tx.recipient] = self.__received.get(tx.recipient, 0) - tx.amount
+
+    def __apply(self, block):
+        for tx in block.transactions:
+            self.__sent[tx.sender] = self.__sent.get(tx.sender, 0) + tx.amount
+            self.__received[tx.recipient] = self.__received.get(tx.recipient, 0) + tx.amount
+
+    def add_pending(self, transaction):
+        """ Account for an open transaction which is not yet included in a block """
+        self.__ensure_built()
+        self.__pending[transaction.sender] = self.__pending.get(transaction.sender, 0) + transaction.amount
+
+    def remove_pending(self, transaction):
+        """ Forget an open transaction, e.g. once it has been included in a block """
+        self.__ensure_built()
+        remaining = self.__pending.get(transaction.sender, 0) - transaction.amount
+        if remaining > 0:
+            self.__pending[transaction.sender] = remaining
+        else:
+            self.__pending.pop(transaction.sender, None)
+
+    def clear_pending(self):
+        """ Drop all open transactions, e.g. after mining or a chain replacement """
+        self.__ensure_built()
+        self.__pending = {}
+
+    def balance(self, participant):
+        """ Return confirmed received minus confirmed and pending sent for a participant """
+        self.__ensure_built()
+        # Open transactions count against the sender to prevent sending globally more than he has,
+        # but received coins only count once they are confirmed in a block
+        amount_sent = self.__sent.get(participant, 0) + self.__pending.get(participant, 0)
+        return self.__received.get(participant, 0) - amount_sent
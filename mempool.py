@@ -0,0 +1,56 @@
+DROP_OLDEST = 'drop-oldest' # make room for a new transaction by evicting the oldest one
+REJECT_NEW = 'reject-new' # keep the pool as it is and refuse the new transaction
+
+class Mempool:
+    """ The open transactions indexed by transaction id, in the order they arrived.
+
+    Attributes:
+        :max_size: The maximum number of open transactions
+        :policy: What happens when a transaction arrives at a full pool, DROP_OLDEST or REJECT_NEW
+        :transactions (private): The transactions by id, a dict keeps the insertion order
+    """
+    def __init__(self, max_size=10000, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, REJECT_NEW):
+            raise ValueError('Unknown mempool policy: {}'.format(policy))
+        self.max_size = max_size
+        self.policy = policy
+        self.__transactions = {}
+
+    def __len__(self):
+        return len(self.__transactions)
+
+    def __iter__(self):
+        return iter(list(self.__transactions.values()))
+
+    def __contains__(self, tx_id):
+        return tx_id in self.__transactions
+
+    def transactions(self):
+        """ Return a list of the open transactions, oldest first """
+        return list(self.__transactions.values())
+
+    def add(self, transaction):
+        """ Add a transaction unless it's already there or the pool is full under REJECT_NEW
+
+        Returns:
+            (whether it was added, list of evicted transactions)
+        """
+        tx_id = transaction.id
+        if tx_id in self.__transactions:
+            return False, []
+        evicted = []
+        if len(self.__transactions) >= self.max_size:
+            if self.policy == REJECT_NEW:
+                return False, []
+            while len(self.__transactions) >= self.max_size and self.__transactions:
+                oldest_id = next(iter(self.__transactions))
+                evicted.append(self.__transactions.pop(oldest_id))
+        self.__transactions[tx_id] = transaction
+        return True, evicted
+
+    def remove(self, tx_id):
+        """ Remove a transaction by id and return it, None if it isn't in the pool """
+        return self.__transactions.pop(tx_id, None)
+
+    def clear(self):
+        self.__transactions = {}
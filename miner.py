@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+
+QUEUED = 'queued'
+MINING = 'mining'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Miner:
+    """ Runs mining jobs one after the other on a background thread so that a request doesn't wait for the proof of work.
+
+    Attributes:
+        :get_blockchain (private): Returns the current Blockchain when a job starts (it's replaced when the wallet changes)
+        :jobs (private): The job dicts by id, oldest first
+        :max_jobs: Finished jobs beyond that number are forgotten, oldest first
+    """
+    def __init__(self, get_blockchain, max_jobs=100):
+        self.max_jobs = max_jobs
+        self.__get_blockchain = get_blockchain
+        self.__jobs = OrderedDict()
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='miner')
+
+    def submit(self):
+        """ Queue a mining job
+
+        Returns:
+            The job id and a Future which resolves once the job is done or failed
+        """
+        with self.__lock:
+            job_id = next(self.__ids)
+            self.__jobs[job_id] = {'id': job_id, 'status': QUEUED, 'message': 'Waiting for the previous jobs.'}
+            self.__forget_finished()
+        return job_id, self.__executor.submit(self.__run, job_id)
+
+    def __forget_finished(self):
+        finished = [job_id for job_id, job in self.__jobs.items() if job['status'] in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(self.__jobs) - self.max_jobs)]:
+            del self.__jobs[job_id]
+
+    def __update(self, job_id, **fields):
+        with self.__lock:
+            self.__jobs[job_id].update(fields)
+
+    def __run(self, job_id):
+        blockchain = self.__get_blockchain()
+        if blockchain.resolve_conflicts: # Conflict check
+            self.__update(job_id, status=FAILED, message='Resolve conflicts first, block not added!')
+            return
+        self.__update(job_id, status=MINING, message='Searching a proof of work.')
+        try:
+            block = blockchain.mine_block()
+        except Exception as error: # the worker thread must survive a failed job
+            self.__update(job_id, status=FAILED, message='Mining failed: {}'.format(error))
+            return
+        stats = blockchain.get_mining_stats()
+        if block is None:
+            self.__update(job_id, status=FAILED, message='Adding a block failed', wallet_set_up=blockchain.public_key != None, mining=stats)
+        else:
+            self.__update(job_id, status=DONE, message='Block added successfully', block=block.to_dict(), funds=blockchain.get_balance(), mining=stats)
+
+    def get(self, job_id):
+        """ Return a copy of a job dict with the live proof of work progress while it's mining, None for an unknown id """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            job = dict(job) if job is not None else None
+        if job is not None and job['status'] == MINING:
+            job['mining'] = self.__get_blockchain().get_mining_stats()
+        return job
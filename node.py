@@ -1,12 +1,64 @@
-from flask import Flask, jsonify, request, send_from_directory # request allows to extract data from incoming request, send_from_directory allows to send back a file
+import cProfile
+import json
+import os
+from time import perf_counter
+import zlib
+
+from flask import Flask, Response, g, jsonify, request, send_from_directory # request allows to extract data from incoming request, send_from_directory allows to send back a file
 from flask_cors import CORS # allow only clients on a server can send http request to it 
 
 from wallet import Wallet
 from blockchain import Blockchain
+from miner import DONE, Miner
+from utility.codec import CONTENT_TYPE, decode_block, decode_transaction, decode_transactions, iter_encode_blocks
+from utility.hash_util import hash_block, merkle_path
+from utility import metrics
+from utility.verification import Verification
 
 # Python server: RESTFUL Api using Flask
 app = Flask(__name__)
 CORS(app)
+blockchain_options = {} # extra Blockchain arguments from the command line
+miner = Miner(lambda: blockchain) # mines on whatever the global blockchain is when a job starts
+MAX_HISTORY_PAGE = 500 # transactions per page of /address/<key>/history
+profile_options = {'slow': None, 'dir': 'profiles'} # --profile-slow: keep a cProfile dump of the requests taking at least that many seconds
+_request_seconds = metrics.histogram('http_request_seconds', 'Time to handle a request, until the first byte of a streamed body', ('method', 'route', 'status'))
+
+# Time every request, and profile it if asked to
+@app.before_request
+def start_request_timer():
+    g.request_start = perf_counter()
+    g.profile = None
+    if profile_options['slow'] is not None:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError: # another request is being profiled in a thread right now, only one profiler can run at a time
+            return
+        g.profile = profile
+
+@app.after_request
+def record_request(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    elapsed = perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched' # the rule, not the path, keeps the number of label values small
+    _request_seconds.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    profile = g.get('profile')
+    if profile is not None:
+        profile.disable()
+        if elapsed >= profile_options['slow']:
+            os.makedirs(profile_options['dir'], exist_ok=True)
+            file_name = '{}-{}-{}.prof'.format(int(elapsed * 1000), request.method, route.strip('/').replace('/', '_').replace('<', '').replace('>', '').replace(':', '-') or 'root')
+            profile.dump_stats(os.path.join(profile_options['dir'], file_name))
+            print('Slow request {} {} took {:.3f}s, profile saved to {}'.format(request.method, request.path, elapsed, file_name))
+    return response
+
+# Metrics of the node in the Prometheus text format, for a scraper or a quick look with curl
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 #### Root route: returns a node.html file inside a folder. 
    ## This is how we connect a client (node.html | desktop app | mobile app) to a server, an alternative to postman app
@@ -27,7 +79,7 @@ def create_keys():
     wallet.create_keys()
     if wallet.save_keys():  # save keys into a file    
         global blockchain
-        blockchain = Blockchain(wallet.public_key, port) # update the global blockchain with the newly created key
+        blockchain = Blockchain(wallet.public_key, port, **blockchain_options) # update the global blockchain with the newly created key
         response = {'public_key': wallet.public_key, 'private_key': wallet.private_key,  'funds': blockchain.get_balance()}
         return jsonify(response), 201
     else:
@@ -39,7 +91,7 @@ def create_keys():
 def load_keys():
     if wallet.load_keys():
         global blockchain
-        blockchain = Blockchain(wallet.public_key, port) # update the global blockchain with the newly created key
+        blockchain = Blockchain(wallet.public_key, port, **blockchain_options) # update the global blockchain with the newly created key
         response = {'public_key': wallet.public_key, 'private_key': wallet.private_key, 'funds': blockchain.get_balance()}
         return jsonify(response), 201
     else:
@@ -59,10 +111,19 @@ def get_balance():
 
 #################################
 
+# Peers send their data either as JSON or in the binary format of utility.codec, told apart by the Content-Type
+def get_request_data(decode):
+    if request.mimetype == CONTENT_TYPE:
+        try:
+            return decode(request.get_data())
+        except ValueError:
+            return None # malformed, answered like missing data
+    return request.get_json()
+
 # Add Broadcast route to the receiver peer_node
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    data = request.get_json() # Extract transaction as dict_data in json format from this incoming request
+    data = get_request_data(decode_transaction) # Extract transaction as dict_data from this incoming request
     if not data:
         response = {'message': 'No transaction data found in this incoming request.'}
         return jsonify(response), 400
@@ -70,6 +131,12 @@ def broadcast_transaction():
     if not all(key in data for key in required):
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400 
+    if not Verification.valid_amount(data['amount']):
+        response = {'message': 'Amount must be a positive number.'}
+        return jsonify(response), 400
+    if not Verification.valid_transaction_fields(data['sender'], data['recipient'], data['signature'], data['amount']):
+        response = {'message': 'Sender, recipient and signature must be texts.'}
+        return jsonify(response), 400
     # Calling add_transaction without contacting the peer_node of the peer_node of the peer_node ...
     success = blockchain.add_transaction(data['recipient'], data['sender'], data['signature'], data['amount'], is_receiving=True)
     if success:
@@ -87,10 +154,33 @@ def broadcast_transaction():
         response = {'message': 'Adding a transaction failed.'}
         return jsonify(response), 500
     
+# Batch of transactions from a peer_node, every transaction gets its own result
+@app.route('/broadcast-transactions', methods=['POST'])
+def broadcast_transactions():
+    data = get_request_data(lambda body: {'transactions': decode_transactions(body)})
+    if not data:
+        response = {'message': 'No transaction data found in this incoming request.'}
+        return jsonify(response), 400
+    if 'transactions' not in data or not isinstance(data['transactions'], list):
+        response = {'message': 'Some data is missing.'}
+        return jsonify(response), 400
+    required = ['sender', 'recipient', 'amount', 'signature']
+    complete = [tx for tx in data['transactions'] if isinstance(tx, dict) and all(key in tx for key in required)]
+    accepted = iter(blockchain.add_transactions(complete))
+    results = []
+    for tx in data['transactions']:
+        if isinstance(tx, dict) and all(key in tx for key in required):
+            success = next(accepted)
+            results.append({'accepted': success, 'message': 'Successfully added transaction' if success else 'Adding a transaction failed.'})
+        else:
+            results.append({'accepted': False, 'message': 'Some data is missing.'})
+    response = {'message': 'Processed {} transactions.'.format(len(results)), 'results': results}
+    return jsonify(response), 200
+
 # Broadcasting a new block to receiver peer_node
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    data = request.get_json() # Extract block as dict_data in json format from this incoming request
+    data = get_request_data(lambda body: {'block': decode_block(body)}) # Extract block as dict_data from this incoming request
     if not data:
         response = {'message': 'No block data found in this incoming request.'}
         return jsonify(response), 400
@@ -98,14 +188,15 @@ def broadcast_block():
         response = {'message': 'Some block data is missing.'}
         return jsonify(response), 400
     block = data['block']
-    if block['index'] == blockchain.chain[-1].index + 1: # if incoming block is accepted, i.e. index is equals to local blockchain index
+    tip_index = blockchain.get_height() - 1 # no copy of the chain needed
+    if block['index'] == tip_index + 1: # if incoming block is accepted, i.e. index is equals to local blockchain index
         if blockchain.add_block(block):
             response = {'message': 'Block added when broadcasting.'}
             return jsonify(response), 201
         else:
             response = {'message': 'Block seems invalid when broadcasting.'}
             return jsonify(response), 409 # conflict but we don't to deal with it rn
-    elif block['index'] > blockchain.chain[-1].index: # if True then it's a problem on the peer node -> (conflict)
+    elif block['index'] > tip_index: # if True then it's a problem on the peer node -> (conflict)
         response = {'message': 'Blockchain seems to differ from local blockchain.'}
         blockchain.resolve_conflicts = True
         return jsonify(response), 200 # we will have to deal with that
@@ -127,9 +218,19 @@ def add_transaction():
     if not all(field in data for field in required_fields):
         response = {'message': 'Required data is missing.'}
         return jsonify(response), 400
+    if not Verification.valid_amount(data['amount']):
+        response = {'message': 'Amount must be a positive number.'}
+        return jsonify(response), 400
+    if type(data['recipient']) is not str:
+        response = {'message': 'Recipient must be a text.'}
+        return jsonify(response), 400
     recipient = data['recipient']
     amount = data['amount']
     signature = wallet.sign_transaction(wallet.public_key, recipient, amount)
+    if blockchain.has_open_transaction(recipient, wallet.public_key, signature, amount):
+        # Same recipient and amount give the same signature, so the same transaction
+        response = {'message': 'Duplicate: the same transaction is already pending, send it again once it is mined.'}
+        return jsonify(response), 409
     success = blockchain.add_transaction(recipient, wallet.public_key, signature, amount)
     if success:
         response = {
@@ -147,22 +248,82 @@ def add_transaction():
         response = {'message': 'Adding a transaction failed.'}
         return jsonify(response), 500
 
+# Add many transactions of this node's wallet at once, e.g. payouts: one signer, one funds check
+# against the ledger in order, one journal write and one broadcast per peer, with a result per item
+@app.route('/transactions/batch', methods=['POST'])
+def add_transactions_batch():
+    if wallet.public_key == None:
+        response = {'message': 'No wallet set up.'}
+        return jsonify(response), 400
+    data = request.get_json()
+    if not data:
+        response = {'message': 'No transaction data found in this incoming request.'}
+        return jsonify(response), 400
+    if 'transactions' not in data or not isinstance(data['transactions'], list):
+        response = {'message': 'Some data is missing.'}
+        return jsonify(response), 400
+    required_fields = ['recipient', 'amount']
+    complete = []
+    for item in data['transactions']:
+        if isinstance(item, dict) and all(field in item for field in required_fields):
+            signature = wallet.sign_transaction(wallet.public_key, item['recipient'], item['amount'])
+            complete.append({'sender': wallet.public_key, 'recipient': item['recipient'], 'amount': item['amount'], 'signature': signature})
+    # Pending already or earlier in this batch: same recipient and amount give the same signature, so the same transaction
+    signatures = set()
+    duplicates = []
+    for transaction in complete:
+        duplicates.append(transaction['signature'] in signatures or blockchain.has_open_transaction(**transaction))
+        signatures.add(transaction['signature'])
+    accepted = iter(blockchain.add_transactions(complete, is_receiving=False))
+    duplicate = iter(duplicates)
+    transactions = iter(complete)
+    results = []
+    for item in data['transactions']:
+        if isinstance(item, dict) and all(field in item for field in required_fields):
+            transaction = next(transactions)
+            is_duplicate = next(duplicate)
+            if next(accepted):
+                results.append({'accepted': True, 'message': 'Successfully added transaction', 'transaction': transaction})
+            elif not Verification.valid_amount(transaction['amount']):
+                results.append({'accepted': False, 'message': 'Amount must be a positive number.', 'transaction': transaction})
+            elif type(transaction['recipient']) is not str:
+                results.append({'accepted': False, 'message': 'Recipient must be a text.', 'transaction': transaction})
+            elif is_duplicate:
+                results.append({'accepted': False, 'message': 'Duplicate: the same transaction is already pending, send it again once it is mined.', 'transaction': transaction})
+            else:
+                results.append({'accepted': False, 'message': 'Adding a transaction failed.', 'transaction': transaction})
+        else:
+            results.append({'accepted': False, 'message': 'Required data is missing.'})
+    response = {
+        'message': 'Processed {} transactions.'.format(len(results)),
+        'accepted': sum(1 for result in results if result['accepted']),
+        'results': results,
+        'funds': blockchain.get_balance()
+    }
+    return jsonify(response), 200
+
+# Mining runs in the background: the answer is a job id to poll with GET /mine/<job_id>,
+# or the finished job with ?wait=true
 @app.route('/mine', methods=['POST'])
 def mine():
     if blockchain.resolve_conflicts: # Conflict check
         response = {'message': 'Resolve conflicts first, block not added!'}
         return jsonify(response), 409
-    
-    block = blockchain.mine_block()
-    
-    if block != None:
-        dict_block = block.__dict__.copy() # convert object block to a dict_block
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
-        response = {'message': 'Block added successfully', 'block': dict_block, 'funds': blockchain.get_balance()}
-        return jsonify(response), 201
-    else: 
-        response = {'message': 'Adding a block failed', 'wallet_set_up': wallet.public_key != None}
-        return jsonify(response), 500
+    job_id, finished = miner.submit()
+    if request.args.get('wait', 'false').lower() in ('1', 'true', 'yes'):
+        finished.result()
+        job = miner.get(job_id)
+        return jsonify(job), 201 if job['status'] == DONE else 500
+    response = {'message': 'Mining job queued', 'job_id': job_id}
+    return jsonify(response), 202
+
+@app.route('/mine/<int:job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = miner.get(job_id)
+    if job is None:
+        response = {'message': 'Mining job not found.'}
+        return jsonify(response), 404
+    return jsonify(job), 200
 
 # Resolve Conflict route
 @app.route('/resolve-conflicts', methods=['POST'])
@@ -178,16 +339,110 @@ def resolve_conflicts():
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
     transactions = blockchain.get_open_transactions()
-    dict_transactions = [tx.__dict__ for tx in transactions]
+    dict_transactions = [tx.to_dict() for tx in transactions]
     return jsonify(dict_transactions), 200
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']] # update the tx as __dict__
-    return jsonify(dict_chain), 200
+    chain_view = blockchain.chain # a snapshot, no copy of the chain
+    height = len(chain_view)
+    # Optional height range ?from=<height>&to=<height> (to excluded), e.g. to fetch only the blocks after a fork,
+    # or pages of ?offset=<height>&limit=<number of blocks>
+    start = max(request.args.get('from', request.args.get('offset', 0, type=int), type=int), 0)
+    limit = request.args.get('limit', type=int)
+    stop = request.args.get('to', height if limit is None else start + max(limit, 0), type=int)
+    stop = max(min(stop, height), start)
+    binary = CONTENT_TYPE in request.accept_mimetypes.values() # only peers asking for it explicitly get the binary format
+    compress = 'gzip' in request.accept_encodings
+    # The tip hash identifies the whole chain, so an unchanged chain is answered without serializing any block
+    etag = '{}-{}-{}-{}{}'.format(hash_block(chain_view[height - 1]), start, stop, 'bin' if binary else 'json', '-gz' if compress else '')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        blocks = (chain_view[index].to_dict() for index in range(start, stop)) # with the tx as dicts, one block at a time
+        if binary:
+            chunks = iter_encode_blocks(blocks, stop - start)
+        else:
+            chunks = iter_json_blocks(blocks)
+        if compress:
+            chunks = iter_gzip(chunks)
+        response = Response(chunks, status=200, mimetype=CONTENT_TYPE if binary else 'application/json')
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['X-Chain-Height'] = str(height) # lets a client page through the chain
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+# Encode the blocks of a JSON list one after the other instead of the whole list at once
+def iter_json_blocks(blocks):
+    yield '['
+    for index, block in enumerate(blocks):
+        yield (',' if index else '') + json.dumps(block)
+    yield ']'
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=31) # 31: gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+# Height and hash of the last block so peers can tell whether they need to sync without fetching the chain
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    tip = blockchain.get_last_blockchain_value()
+    response = {'height': tip.index + 1, 'index': tip.index, 'hash': hash_block(tip)}
+    return jsonify(response), 200
+
+# Inclusion proof of a transaction: the block's Merkle root and the sibling hashes leading up to it,
+# checked with Verification.verify_merkle_proof without the other transactions of the block
+@app.route('/block/<int:index>/proof/<tx_id>', methods=['GET'])
+def get_transaction_proof(index, tx_id):
+    chain_view = blockchain.chain
+    if index < 0 or index >= len(chain_view):
+        response = {'message': 'Block not found.'}
+        return jsonify(response), 404
+    block = chain_view[index]
+    if block.merkle_root is None:
+        response = {'message': 'Block has no Merkle root, it was mined before them.'}
+        return jsonify(response), 404
+    tx_ids = [tx.id for tx in block.transactions]
+    if tx_id not in tx_ids:
+        response = {'message': 'Transaction not found in block.'}
+        return jsonify(response), 404
+    response = {
+        'index': index,
+        'block_hash': hash_block(block),
+        'merkle_root': block.merkle_root,
+        'tx_id': tx_id,
+        'proof': merkle_path(tx_ids, tx_ids.index(tx_id))
+    }
+    return jsonify(response), 200
+
+# The transactions an address sent or received, newest first, one page at a time:
+# ?limit=<number>, then ?cursor=<next_cursor of the previous page> until next_cursor is null
+@app.route('/address/<key>/history', methods=['GET'])
+def get_address_history(key):
+    limit = min(max(request.args.get('limit', 50, type=int), 1), MAX_HISTORY_PAGE)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            height, position = (int(part) for part in cursor.split('-'))
+        except ValueError:
+            response = {'message': 'Invalid cursor.'}
+            return jsonify(response), 400
+        cursor = (height, position)
+    else:
+        cursor = None
+    history, next_cursor = blockchain.get_address_history(key, cursor, limit)
+    response = {
+        'address': key,
+        'transactions': history,
+        'next_cursor': '{}-{}'.format(*next_cursor) if next_cursor is not None else None
+    }
+    return jsonify(response), 200
 
 # Add node route without a wallet
 @app.route('/node', methods=['POST'])
@@ -228,9 +483,48 @@ if __name__ == '__main__':
     from argparse import ArgumentParser 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--lazy-load', action='store_true', help='decode stored blocks on demand for a fast startup')
+    parser.add_argument('--pow-workers', type=int, default=1, help='number of processes searching the proof of work')
+    parser.add_argument('--difficulty', type=int, default=8, help='leading zero bits of a valid proof of work hash')
+    parser.add_argument('--verify-workers', type=int, default=1, help='number of processes checking batches of signatures')
+    parser.add_argument('--mempool-size', type=int, default=10000, help='maximum number of open transactions')
+    parser.add_argument('--mempool-policy', choices=['drop-oldest', 'reject-new'], default='drop-oldest', help='what to do when the mempool is full')
+    parser.add_argument('--peer-timeout', type=float, default=5, help='seconds to wait for a peer node')
+    parser.add_argument('--async-broadcast', action='store_true', help='send transactions and blocks to peers in the background')
+    parser.add_argument('--gossip-window', type=float, default=0.05, help='seconds outgoing transactions are collected into one batch, 0 sends each right away')
+    parser.add_argument('--gossip-batch-size', type=int, default=100, help='maximum transactions per outgoing batch')
+    parser.add_argument('--key-cache-size', type=int, default=1024, help='parsed public keys kept in memory')
+    parser.add_argument('--signature-cache-size', type=int, default=65536, help='verified signatures remembered')
+    parser.add_argument('--wire-format', choices=['binary', 'json'], default='binary', help='format of blocks and transactions sent to peers, binary falls back to json for older peers')
+    parser.add_argument('--storage-format', choices=['binary', 'json'], default='binary', help='format of the block log of a new node folder')
+    parser.add_argument('--archive', action='store_true', help='compress full segments of the block log into archives and keep only recent blocks in memory, implies --lazy-load')
+    parser.add_argument('--hot-blocks', type=int, default=100, help='with --lazy-load, most recent blocks kept as objects')
+    parser.add_argument('--block-cache-size', type=int, default=256, help='with --lazy-load, older blocks kept decoded after a read')
+    parser.add_argument('--checkpoint-interval', type=int, default=100, help='blocks between two stored checkpoints of the balances, 0 turns them off')
+    parser.add_argument('--profile-slow', type=float, default=None, metavar='SECONDS', help='profile every request and keep the cProfile dumps of those taking at least that long')
+    parser.add_argument('--profile-dir', default='profiles', help='folder of the dumps of --profile-slow')
     args = parser.parse_args() # to extract the above args
     port = args.port # to access the port arg (print(args))
+    blockchain_options['lazy_load'] = args.lazy_load
+    blockchain_options['pow_workers'] = args.pow_workers
+    blockchain_options['difficulty'] = args.difficulty
+    blockchain_options['verify_workers'] = args.verify_workers
+    blockchain_options['mempool_size'] = args.mempool_size
+    blockchain_options['mempool_policy'] = args.mempool_policy
+    blockchain_options['peer_timeout'] = args.peer_timeout
+    blockchain_options['async_broadcast'] = args.async_broadcast
+    blockchain_options['gossip_window'] = args.gossip_window
+    blockchain_options['gossip_batch_size'] = args.gossip_batch_size
+    blockchain_options['wire_format'] = args.wire_format
+    blockchain_options['storage_format'] = args.storage_format
+    blockchain_options['checkpoint_interval'] = args.checkpoint_interval
+    blockchain_options['archive'] = args.archive
+    blockchain_options['hot_blocks'] = args.hot_blocks
+    blockchain_options['block_cache_size'] = args.block_cache_size
+    profile_options['slow'] = args.profile_slow
+    profile_options['dir'] = args.profile_dir
+    Wallet.configure_caches(args.key_cache_size, args.signature_cache_size)
     wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
+    blockchain = Blockchain(wallet.public_key, port, **blockchain_options)
 
     app.run(host='0.0.0.0', port=port) # localhost/5000/ +path, where path is defined in each route
\ No newline at end of file
@@ -1,5 +1,8 @@
 from collections import OrderedDict
+import json
+import sys
 
+from utility.hash_util import hash_string_256
 from utility.printable import Printable
 
 class Transaction(Printable):
@@ -10,11 +13,27 @@ class Transaction(Printable):
         :signature: The signature of the transactions
         :amount: The amount of coins sent
     """
+    __slots__ = ('sender', 'recipient', 'amount', 'signature', '_id') # no per-transaction __dict__
+
     def __init__(self, sender, recipient, signature, amount):
-        self.sender = sender
-        self.recipient = recipient # recipient is a public_key, like a uuid
+        # Public keys are interned: every transaction of the same address shares one string instead of a copy each
+        self.sender = sys.intern(sender) if type(sender) is str else sender
+        self.recipient = sys.intern(recipient) if type(recipient) is str else recipient # recipient is a public_key, like a uuid
         self.amount = amount
         self.signature = signature
+        self._id = None
+
+    @property
+    def id(self):
+        """ Content hash which identifies the transaction, the same on every node. Computed once, the fields of a
+            transaction don't change. Signatures are deterministic, so two identical payments have the same id """
+        if self._id is None:
+            self._id = hash_string_256(json.dumps([self.sender, self.recipient, self.amount, self.signature]).encode())
+        return self._id
+
+    # The transaction as a dict, e.g. for JSON
+    def to_dict(self):
+        return {'sender': self.sender, 'recipient': self.recipient, 'amount': self.amount, 'signature': self.signature}
 
     # To guarantee in the dictionary the keys keep the same order
     def to_ordered_dict(self):
@@ -0,0 +1,228 @@
+""" Provides concurrent delivery of transactions and blocks to the peer nodes """
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import threading
+from time import perf_counter
+
+import requests
+
+from utility.codec import CONTENT_TYPE
+from utility import metrics
+
+TIMEOUT = 5 # seconds before a peer counts as unreachable
+
+_broadcasters = {} # shared broadcasters by timeout
+
+_request_seconds = metrics.histogram('broadcast_request_seconds', 'Time to post to a peer', ('peer', 'path'))
+_failures = metrics.counter('broadcast_failures_total', 'Posts to a peer which failed, it was unreachable or declined', ('peer', 'path', 'reason'))
+
+
+class Broadcaster:
+    """ Posts the same payload to all peer nodes at once over kept-alive connections.
+
+    Attributes:
+        :timeout: Seconds to wait for a peer (connect and read) before giving up on it
+        :sessions (private): One requests.Session per peer so connections get reused between broadcasts
+        :json_only (private): The peers which declined the binary format, they get JSON from then on
+        :executor (private): The threads sending the requests
+    """
+    def __init__(self, timeout=TIMEOUT, max_workers=16):
+        self.timeout = timeout
+        self.__sessions = {}
+        self.__json_only = set()
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='broadcast')
+
+    @staticmethod
+    def shared(timeout=TIMEOUT):
+        """ Return the broadcaster of the process so that a new Blockchain reuses the open connections """
+        if timeout not in _broadcasters:
+            _broadcasters[timeout] = Broadcaster(timeout)
+        return _broadcasters[timeout]
+
+    def __session(self, node):
+        with self.__lock:
+            session = self.__sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                self.__sessions[node] = session
+            return session
+
+    def __post(self, node, path, payload, data=None):
+        """ Return one peer's answer as (status code, JSON body or None), (None, None) if it's down or too slow.
+            The binary encoding of the payload is sent instead if given, unless the peer only takes JSON """
+        start = perf_counter()
+        status, body = self.__send(node, path, payload, data)
+        _request_seconds.observe(perf_counter() - start, peer=node, path=path)
+        if status is None:
+            _failures.inc(peer=node, path=path, reason='unreachable')
+        elif status >= 400:
+            _failures.inc(peer=node, path=path, reason='declined')
+        return status, body
+
+    def __send(self, node, path, payload, data):
+        url = 'http://{}/{}'.format(node, path)
+        try:
+            if data is not None and node not in self.__json_only:
+                response = self.__session(node).post(url, data=data, headers={'Content-Type': CONTENT_TYPE}, timeout=self.timeout)
+                if response.status_code != 415:
+                    return self.__answer(response)
+                self.__json_only.add(node) # an older node, fall back to JSON
+            response = self.__session(node).post(url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return None, None # skip a node if it's down
+        return self.__answer(response)
+
+    @staticmethod
+    def __answer(response):
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+    def post_all_json(self, nodes, path, payload, data=None):
+        """ Post a payload to every node concurrently and wait for all answers
+
+        Arguments:
+            :data: Optional binary encoding of the payload (utility.codec), sent to the peers which accept it
+
+        Returns:
+            A dict with (status code, JSON body) per node, (None, None) for the nodes which couldn't be reached
+        """
+        futures = {node: self.__executor.submit(self.__post, node, path, payload, data) for node in nodes}
+        wait(futures.values())
+        return {node: future.result() for node, future in futures.items()}
+
+    def post_all(self, nodes, path, payload, data=None):
+        """ Like post_all_json but returns only the status code per node, None for the nodes which couldn't be reached """
+        return {node: status for node, (status, _) in self.post_all_json(nodes, path, payload, data).items()}
+
+    def post_all_async(self, nodes, path, payload, callback=None, data=None):
+        """ Like post_all but returns right away, the optional callback gets the status codes once all peers answered """
+        nodes = list(nodes)
+        def run():
+            statuses = self.post_all(nodes, path, payload, data)
+            if callback is not None:
+                callback(statuses)
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, node, path, **kwargs):
+        """ GET from one node over its kept-alive connection, the timeout applies unless given """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.__session(node).get('http://{}/{}'.format(node, path), **kwargs)
+
+    def __get_json(self, node, path):
+        try:
+            response = self.get(node, path)
+            return response.json() if response.status_code == 200 else None
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    def get_all_json(self, nodes, path):
+        """ GET a path from every node concurrently
+
+        Returns:
+            A dict with the JSON body per node, None for the nodes which couldn't be reached or failed
+        """
+        futures = {node: self.__executor.submit(self.__get_json, node, path) for node in nodes}
+        wait(futures.values())
+        return {node: future.result() for node, future in futures.items()}
+
+
+class TransactionBatcher:
+    """ Coalesces the transactions broadcast within a short window into one /broadcast-transactions
+        request per peer instead of one request per transaction and peer.
+
+    Attributes:
+        :window: Seconds to wait for more transactions after the first one of a batch
+        :max_items: A batch is sent right away once it holds that many transactions
+        :encode (private): Optional binary encoder of a transaction list (utility.codec), None sends JSON only
+        :broadcaster (private): Sends the batches
+        :get_peers (private): Returns the current peer nodes when a batch is sent
+        :queue (private): (transaction dict, Future) pairs waiting to be sent
+    """
+    def __init__(self, broadcaster, get_peers, window=0.05, max_items=100, encode=None):
+        self.window = window
+        self.max_items = max_items
+        self.__encode = encode
+        self.__broadcaster = broadcaster
+        self.__get_peers = get_peers
+        self.__queue = []
+        self.__timer = None
+        self.__lock = threading.Lock()
+
+    def submit(self, transaction):
+        """ Queue a transaction dict for the next batch
+
+        Returns:
+            A Future which resolves to False if any peer declined the transaction, True otherwise
+        """
+        future = Future()
+        if not self.__get_peers(): # nobody to tell, no reason to wait for the window
+            future.set_result(True)
+            return future
+        with self.__lock:
+            self.__queue.append((transaction, future))
+            if len(self.__queue) >= self.max_items:
+                batch = self.__take()
+            else:
+                batch = None
+                if self.__timer is None:
+                    self.__timer = threading.Timer(self.window, self.flush)
+                    self.__timer.daemon = True
+                    self.__timer.start()
+        if batch:
+            self.__send(batch)
+        return future
+
+    def __take(self):
+        batch = self.__queue
+        self.__queue = []
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        return batch
+
+    def flush(self):
+        """ Send the queued transactions now """
+        with self.__lock:
+            batch = self.__take()
+        if batch:
+            self.__send(batch)
+
+    def __send(self, batch):
+        accepted = []
+        try:
+            accepted = self.send([transaction for transaction, _ in batch])
+        except Exception as error: # e.g. a broken encoder, the callers still get their answer
+            print('Broadcasting transactions failed: {}'.format(error))
+        finally:
+            # Every future gets resolved, one left pending would keep its caller waiting
+            for position, (_, future) in enumerate(batch):
+                future.set_result(position < len(accepted) and accepted[position])
+
+    def send(self, transactions):
+        """ Send a list of transaction dicts to all peers in one request each, right away and without the queue
+
+        Returns:
+            A list with False per transaction any peer declined, True otherwise
+        """
+        accepted = [True] * len(transactions)
+        data = self.__encode(transactions) if self.__encode is not None else None
+        answers = self.__broadcaster.post_all_json(self.__get_peers(), 'broadcast-transactions', {'transactions': transactions}, data)
+        for node, (status, body) in answers.items():
+            if status == 404: # a peer without the batch endpoint gets them one by one
+                for position, transaction in enumerate(transactions):
+                    status = self.__broadcaster.post_all([node], 'broadcast-transaction', transaction)[node]
+                    if status == 400 or status == 500:
+                        accepted[position] = False
+            elif status == 400 or status == 500:
+                accepted = [False] * len(transactions)
+            elif status is not None and isinstance(body, dict):
+                results = body.get('results')
+                if not isinstance(results, list): # not an answer of ours
+                    continue
+                for position, result in enumerate(results[:len(transactions)]):
+                    if not isinstance(result, dict) or not result.get('accepted'):
+                        accepted[position] = False
+        return accepted
@@ -0,0 +1,41 @@
+""" Provides read-only snapshots of a chain which cost nothing to take """
+
+
+class ChainView:
+    """ The first blocks of an append-only sequence of blocks (a list or a LazyChain). As blocks are only
+        ever appended to the sequence and a replaced chain is a new sequence, the view never changes:
+        taking one copies nothing and readers don't need a lock.
+
+    Attributes:
+        :version: The version of the chain the view was taken from, changes with every appended or replaced block
+    """
+    __slots__ = ('_blocks', '_length', 'version')
+
+    def __init__(self, blocks, length, version=0):
+        self._blocks = blocks
+        self._length = length
+        self.version = version
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._blocks[height] for height in range(*key.indices(self._length))]
+        if key < 0:
+            key += self._length
+        if key < 0 or key >= self._length:
+            raise IndexError('chain index out of range')
+        return self._blocks[key]
+
+    def __iter__(self):
+        for height in range(self._length):
+            yield self._blocks[height]
+
+    def __repr__(self):
+        return 'ChainView(length={}, version={})'.format(self._length, self.version)
+
+    @property
+    def tip(self):
+        """ The last block of the view """
+        return self[-1]
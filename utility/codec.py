@@ -0,0 +1,215 @@
+""" Provides a compact binary format for blocks and transactions, an alternative to JSON on disk and between nodes.
+
+Every encoded message starts with the format version. Texts which are hex (public keys, signatures, hashes) are
+stored as their raw bytes, other texts (e.g. the 'MINING' sender) as UTF8. All texts are prefixed with their length.
+The block hash is still computed from the JSON form by hash_block, so it doesn't depend on the format.
+Version 2 adds the optional Merkle root of a block, version 1 messages (e.g. stored blocks) are still read.
+"""
+
+import binascii
+import json
+import struct
+
+VERSION = 2
+CONTENT_TYPE = 'application/vnd.blockchain.v2+binary' # negotiated on /chain, /broadcast-block and /broadcast-transaction(s)
+
+_HEX, _UTF8 = 0, 1 # text tags
+_INT, _FLOAT, _JSON = 0, 1, 2 # value tags
+_LENGTH = struct.Struct('>I')
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+
+
+def _pack_text(parts, text):
+    if type(text) is not str:
+        raise ValueError('Text expected, got {!r}'.format(text))
+    try:
+        raw = binascii.unhexlify(text)
+        if binascii.hexlify(raw).decode('ascii') != text: # e.g. upper case hex would not come back the same
+            raise ValueError(text)
+        tag = _HEX
+    except (ValueError, TypeError, binascii.Error):
+        raw = text.encode('utf8')
+        tag = _UTF8
+    parts.append(bytes((tag,)))
+    parts.append(_LENGTH.pack(len(raw)))
+    parts.append(raw)
+
+
+def _pack_value(parts, value):
+    """ Numbers keep their Python type (int or float) so that a round trip gives the same JSON and hash """
+    if type(value) is int and -2 ** 63 <= value < 2 ** 63:
+        parts.append(bytes((_INT,)))
+        parts.append(_INT64.pack(value))
+    elif type(value) is float:
+        parts.append(bytes((_FLOAT,)))
+        parts.append(_FLOAT64.pack(value))
+    else:
+        raw = json.dumps(value).encode('utf8')
+        parts.append(bytes((_JSON,)))
+        parts.append(_LENGTH.pack(len(raw)))
+        parts.append(raw)
+
+
+class _Reader:
+    """ Reads the fields of an encoded message one after the other """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.message_version = VERSION
+
+    def byte(self):
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def length(self):
+        (value,) = _LENGTH.unpack_from(self.data, self.offset)
+        self.offset += _LENGTH.size
+        return value
+
+    def raw(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('Truncated message')
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value
+
+    def text(self):
+        tag = self.byte()
+        raw = self.raw(self.length())
+        if tag == _HEX:
+            return raw.hex()
+        return bytes(raw).decode('utf8')
+
+    def value(self):
+        tag = self.byte()
+        if tag == _INT:
+            return _INT64.unpack(self.raw(_INT64.size))[0]
+        if tag == _FLOAT:
+            return _FLOAT64.unpack(self.raw(_FLOAT64.size))[0]
+        return json.loads(bytes(self.raw(self.length())))
+
+    def version(self):
+        self.message_version = self.byte()
+        if not 1 <= self.message_version <= VERSION:
+            raise ValueError('Unsupported format version {}'.format(self.message_version))
+
+
+def _pack_transaction(parts, transaction):
+    _pack_text(parts, transaction['sender'])
+    _pack_text(parts, transaction['recipient'])
+    _pack_value(parts, transaction['amount'])
+    _pack_text(parts, transaction['signature'])
+
+
+def _read_transaction(reader):
+    # Same key order as Transaction.to_dict
+    return {'sender': reader.text(), 'recipient': reader.text(), 'amount': reader.value(), 'signature': reader.text()}
+
+
+def _pack_block(parts, block):
+    _pack_value(parts, block['index'])
+    _pack_text(parts, block['previous_hash'])
+    parts.append(_LENGTH.pack(len(block['transactions'])))
+    for transaction in block['transactions']:
+        _pack_transaction(parts, transaction)
+    _pack_value(parts, block['proof'])
+    _pack_value(parts, block['timestamp'])
+    if block.get('merkle_root') is None:
+        parts.append(bytes((0,)))
+    else:
+        parts.append(bytes((1,)))
+        _pack_text(parts, block['merkle_root'])
+
+
+def _read_block(reader):
+    index = reader.value()
+    previous_hash = reader.text()
+    transactions = [_read_transaction(reader) for _ in range(reader.length())]
+    # Same key order as Block.to_dict
+    block = {'index': index, 'previous_hash': previous_hash, 'transactions': transactions, 'proof': reader.value(), 'timestamp': reader.value()}
+    if reader.message_version >= 2 and reader.byte():
+        block['merkle_root'] = reader.text()
+    return block
+
+
+def encode_transaction(transaction):
+    """ Encode a transaction dict """
+    parts = [bytes((VERSION,))]
+    _pack_transaction(parts, transaction)
+    return b''.join(parts)
+
+
+def decode_transaction(data):
+    """ Decode a transaction dict, raises ValueError for a malformed message """
+    reader = _Reader(data)
+    try:
+        reader.version()
+        return _read_transaction(reader)
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed transaction') from error
+
+
+def encode_transactions(transactions):
+    """ Encode a list of transaction dicts """
+    parts = [bytes((VERSION,)), _LENGTH.pack(len(transactions))]
+    for transaction in transactions:
+        _pack_transaction(parts, transaction)
+    return b''.join(parts)
+
+
+def decode_transactions(data):
+    reader = _Reader(data)
+    try:
+        reader.version()
+        return [_read_transaction(reader) for _ in range(reader.length())]
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed transactions') from error
+
+
+def encode_block(block):
+    """ Encode a block dict with its transactions as dicts """
+    parts = [bytes((VERSION,))]
+    _pack_block(parts, block)
+    return b''.join(parts)
+
+
+def decode_block(data):
+    """ Decode a block dict, raises ValueError for a malformed message """
+    reader = _Reader(data)
+    try:
+        reader.version()
+        return _read_block(reader)
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed block') from error
+
+
+def encode_blocks(blocks):
+    """ Encode a list of block dicts, e.g. a chain """
+    parts = [bytes((VERSION,)), _LENGTH.pack(len(blocks))]
+    for block in blocks:
+        _pack_block(parts, block)
+    return b''.join(parts)
+
+
+def iter_encode_blocks(blocks, count):
+    """ Encode count block dicts like encode_blocks but one block at a time, e.g. to stream a chain
+
+    Arguments:
+        :blocks: An iterable with exactly count block dicts
+    """
+    yield bytes((VERSION,)) + _LENGTH.pack(count)
+    for block in blocks:
+        parts = []
+        _pack_block(parts, block)
+        yield b''.join(parts)
+
+
+def decode_blocks(data):
+    reader = _Reader(data)
+    try:
+        reader.version()
+        return [_read_block(reader) for _ in range(reader.length())]
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed blocks') from error
@@ -9,6 +9,79 @@ def hash_string_256(string):
     return sha256(string).hexdigest()
 
 
+_LEAF = b'\x00' # prefixes keeping a leaf hash from ever equaling an inner node hash (second preimage)
+_NODE = b'\x01'
+
+
+def _merkle_leaves(hashes):
+    return [sha256(_LEAF + bytes.fromhex(leaf)).digest() for leaf in hashes]
+
+
+def _merkle_parents(level):
+    """ Hash a level pairwise, the last hash of a level with an odd length moves up unchanged """
+    parents = [sha256(_NODE + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(hashes):
+    """ Hash a list of hex hashes (e.g. transaction ids) pairwise up to a single hex hash. Leaves and inner
+    nodes are hashed with different prefixes and an odd last hash is promoted instead of paired with itself,
+    so no other list of hashes (e.g. one with the last hash repeated) gives the same root.
+    Any change of a hash or of the order changes the root.
+    """
+    if not hashes:
+        return hash_string_256(b'')
+    level = _merkle_leaves(hashes)
+    while len(level) > 1:
+        level = _merkle_parents(level)
+    return level[0].hex()
+
+
+def merkle_path(hashes, position):
+    """ Return the inclusion proof of the hash at a position of the list: its sibling per level of the
+    tree from the bottom up as {'hash': sibling hex hash, 'position': 'left' or 'right'}. It has at most
+    log2(n) entries, a level where the node is promoted without a sibling adds none.
+    """
+    path = []
+    level = _merkle_leaves(hashes)
+    while len(level) > 1:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append({'hash': level[sibling].hex(), 'position': 'left' if sibling < position else 'right'})
+        level = _merkle_parents(level)
+        position //= 2
+    return path
+
+
+def merkle_node(left, right):
+    """ The inner node hash of two child hashes (bytes), see merkle_root """
+    return sha256(_NODE + left + right).digest()
+
+
+def merkle_leaf(tx_hash):
+    """ The leaf hash (bytes) of a hex hash, see merkle_root """
+    return sha256(_LEAF + bytes.fromhex(tx_hash)).digest()
+
+
+def proof_prefix(transactions, last_hash, merkle_root=None):
+    """ The part of a proof of work guess which is the same for every proof: the transactions as OrderedDict
+    (or the Merkle root of a block which has one) followed by the last hash. Hashing it once and copying the
+    hash object (midstate) saves re-hashing it per proof.
+    """
+    if merkle_root is not None:
+        return (merkle_root + str(last_hash)).encode()
+    return (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)).encode()
+
+
+def proof_target(difficulty):
+    """ The largest 32 bytes raw proof of work digest with 'difficulty' leading zero bits.
+    Comparing bytes of the same length is the same as comparing the numbers they encode (big endian).
+    """
+    return ((1 << (256 - difficulty)) - 1).to_bytes(32, 'big')
+
+
 def hash_block(block):
     """ Use sha256 algo from standard library to create a 64 characters deterministic hash. 
     sha256 takes a string as arg: binary string json encoded in UTF8 string format. Then
@@ -19,7 +92,25 @@ def hash_block(block):
     as a hash is depending on them a well. Otherwise the hash can generate a different value if the order
     of the keys change in one of those dictionaries. This is call a hash order fault.    
     """
+    cached_hash = getattr(block, '_hash', None) # only sealed blocks have one
+    if cached_hash is not None:
+        return cached_hash
     # json can't take an object
-    hashable_block = block.__dict__.copy() # make sure not to modify the object block to be manipulated by hash_string_256
-    hashable_block['transactions'] = [tx.to_ordered_dict() for tx in hashable_block['transactions']]
-    return hash_string_256(json.dumps(hashable_block, sort_keys=True).encode()) # sor_keys=True is still needed?
+    hashable_block = {'index': block.index, 'previous_hash': block.previous_hash, 'proof': block.proof, 'timestamp': block.timestamp}
+    if getattr(block, 'merkle_root', None) is not None:
+        hashable_block['merkle_root'] = block.merkle_root # the root stands for the transactions, no need to serialize them
+    else:
+        hashable_block['transactions'] = [tx.to_ordered_dict() for tx in block.transactions] # legacy block
+    block_hash = hash_string_256(json.dumps(hashable_block, sort_keys=True).encode()) # sor_keys=True is still needed?
+    if hasattr(block, '_hash'):
+        block._hash = block_hash
+    return block_hash
+
+
+def seal_block(block):
+    """ Mark a block as final (mined, received or loaded) so that hash_block computes its hash only once.
+    A sealed block must not be modified anymore, its cached hash would be stale.
+    """
+    if not hasattr(block, '_hash'):
+        block._hash = None # computed by the first hash_block call
+    return block
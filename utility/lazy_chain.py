@@ -0,0 +1,74 @@
+""" Provides a list-like chain whose blocks are decoded from the storage on demand """
+
+from utility.lru_cache import LRUCache
+
+
+class LazyChain:
+    """ A sequence of blocks backed by the block log of a Storage. Only the tail of the chain is kept as
+        objects, older blocks are decoded from the memory mapped (or archived) log when they are accessed,
+        so the memory used by blocks stays the same however long the chain gets.
+
+    Attributes:
+        :storage (private): The Storage holding the blocks
+        :decode (private): Converts a stored block dict into a Block object
+        :tail_size (private): The number of most recent blocks kept as objects
+        :tail (private): The most recently appended blocks by height
+        :cache (private): Recently decoded older blocks by height, an LRUCache
+        :detached (private): Blocks kept as objects because the storage no longer holds them, see detach
+    """
+    def __init__(self, storage, decode, tail_size=100, cache_size=256):
+        self.__storage = storage
+        self.__decode = decode
+        self.__tail_size = max(tail_size, 1)
+        self.__length = storage.height
+        self.__tail = {}
+        self.__cache = LRUCache(cache_size)
+        self.__detached = {}
+        if self.__length:
+            self.__tail[self.__length - 1] = decode(storage.read_block(self.__length - 1)) # the tip is always needed
+
+    def __len__(self):
+        return self.__length
+
+    def __block(self, height):
+        block = self.__tail.get(height) or self.__detached.get(height)
+        if block is not None:
+            return block
+        block = self.__cache.get(height)
+        if block is None:
+            block = self.__decode(self.__storage.read_block(height))
+            self.__cache.put(height, block)
+        return block
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.__block(height) for height in range(*key.indices(self.__length))]
+        if key < 0:
+            key += self.__length
+        if key < 0 or key >= self.__length:
+            raise IndexError('chain index out of range')
+        return self.__block(key)
+
+    def __iter__(self):
+        for height in range(self.__length):
+            yield self.__block(height)
+
+    def __repr__(self):
+        return 'LazyChain(length={})'.format(self.__length)
+
+    def cache_stats(self):
+        """ Return the number of blocks kept as objects, and the size and hit/miss counters of the block cache """
+        return {'tail': len(self.__tail), 'cache': self.__cache.stats()}
+
+    def detach(self, from_height):
+        """ Keep the blocks from a height on as objects, before the storage replaces them (a fork). Snapshots
+            still reading this chain then keep seeing its blocks instead of the new chain's. The blocks below
+            from_height stay in the storage unchanged """
+        for height in range(from_height, self.__length):
+            self.__detached[height] = self.__block(height)
+
+    def append(self, block):
+        """ Append a block which is (about to be) stored at the next height """
+        self.__tail[self.__length] = block
+        self.__tail.pop(self.__length - self.__tail_size, None) # it's in the storage by now, decode it again if needed
+        self.__length += 1
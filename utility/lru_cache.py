@@ -0,0 +1,57 @@
+""" Provides a small thread-safe least recently used cache """
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """ A bounded mapping which forgets the least recently used entry when it's full.
+
+    Attributes:
+        :max_size: The maximum number of entries, 0 disables the cache
+        :hits: The number of get calls which found their key
+        :misses: The number of get calls which didn't
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def resize(self, max_size):
+        with self.__lock:
+            self.max_size = max_size
+            while len(self.__entries) > max(max_size, 0):
+                self.__entries.popitem(last=False)
+
+    def stats(self):
+        """ Return the size and hit/miss counters as a dict """
+        return {'size': len(self.__entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,160 @@
+""" Provides counters, gauges and latency histograms rendered in the Prometheus text format on /metrics
+
+Recording a value is a dict update under a lock, gauges which mirror existing state (chain height,
+mempool size, hash rate) are only computed by a callback when the metrics are rendered.
+"""
+
+from contextlib import contextmanager
+import threading
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+
+_registry = {} # metrics by name, in the order they were created
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """ A named metric with one value per combination of label values """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.setdefault(name, self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def _samples(self):
+        """ Return (name suffix, label values, extra label pairs, value) tuples """
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, key, extra, value in self._samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labels, key, extra), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """ A value which only goes up, e.g. the number of failed requests """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """ A value which goes up and down. It's either set, or read from a function when the metrics are rendered """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.__function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """ Read the value from a function (without arguments) at render time instead, replaces the previous function.
+            For a gauge with labels the function returns a dict of label value tuples to values """
+        self.__function = function
+
+    def _samples(self):
+        function = self.__function
+        if function is not None:
+            try:
+                if self.labels:
+                    return [('', tuple(key), (), value) for key, value in function().items()]
+                return [('', (), (), function())]
+            except Exception: # a failing callback must not break the whole endpoint
+                return []
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    """ The distribution of observed values, e.g. latencies, in cumulative buckets plus their sum and count """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0] # per bucket counts then the sum
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the seconds spent in a with block """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+def counter(name, documentation, labels=()):
+    """ Return the counter of that name, created on first use so that modules can share it """
+    return _registry.get(name) or Counter(name, documentation, labels)
+
+
+def gauge(name, documentation, labels=()):
+    return _registry.get(name) or Gauge(name, documentation, labels)
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    return _registry.get(name) or Histogram(name, documentation, labels, buckets)
+
+
+def render():
+    """ Return all metrics in the Prometheus text exposition format """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,140 @@
+""" Provides a proof of work search which can use several processes """
+
+from hashlib import sha256
+import multiprocessing
+import threading
+from time import time
+
+from utility.hash_util import proof_prefix, proof_target
+from utility.verification import DIFFICULTY
+
+CHUNK_SIZE = 1000 # proofs a worker tries before checking whether another worker already succeeded
+
+_found = None # set in every worker process by _init_worker
+_progress = None # proofs tried by all workers of the current search, set by _init_worker
+_engines = {} # shared engines by number of workers
+
+
+def _init_worker(found, progress):
+    global _found, _progress
+    _found = found
+    _progress = progress
+
+
+def _try_proofs(midstate, target, start, stop):
+    """ Return the first proof in [start, stop) whose hash is within the target, or None.
+    Only the proof gets hashed per attempt, the constant prefix is in the midstate already.
+    """
+    for proof in range(start, stop):
+        guess = midstate.copy()
+        guess.update(b'%d' % proof) # same bytes as str(proof).encode()
+        if guess.digest() <= target:
+            return proof
+    return None
+
+
+def _search(worker, workers, prefix, target):
+    """ Try the chunks of the proof space belonging to one worker until a proof is found by any worker
+
+    Returns:
+        (proof or None, number of proofs tried)
+    """
+    midstate = sha256(prefix)
+    attempts = 0
+    start = worker * CHUNK_SIZE
+    while not _found.is_set():
+        proof = _try_proofs(midstate, target, start, start + CHUNK_SIZE)
+        if proof is not None:
+            _found.set() # stop the other workers
+            return proof, attempts + proof - start + 1
+        attempts += CHUNK_SIZE
+        with _progress.get_lock():
+            _progress.value += CHUNK_SIZE
+        start += workers * CHUNK_SIZE # worker k owns chunks k, k + workers, k + 2 * workers, ...
+    return None, attempts
+
+
+class ProofOfWorkEngine:
+    """ Finds a proof of work for the open transactions, splitting the proofs across worker processes.
+
+    Attributes:
+        :workers: The number of worker processes, 1 searches in the calling process
+        :last_attempts: The number of proofs tried during the last (or the running) search
+        :last_hash_rate: The hashes per second of the last (or the running) search
+        :searching: Whether a search is running
+    """
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.last_attempts = 0
+        self.last_hash_rate = 0.0
+        self.searching = False
+        self.__pool = None
+        self.__found = None
+        self.__progress = None
+        self.__lock = threading.Lock() # one search at a time shares the pool and the stop flag
+
+    @staticmethod
+    def shared(workers=1):
+        """ Return the engine of the process for a number of workers so that a new Blockchain doesn't spawn a new pool """
+        workers = max(1, workers)
+        if workers not in _engines:
+            _engines[workers] = ProofOfWorkEngine(workers)
+        return _engines[workers]
+
+    def __start_pool(self):
+        if self.__pool is None:
+            self.__found = multiprocessing.Event()
+            self.__progress = multiprocessing.Value('Q', 0)
+            self.__pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.__found, self.__progress))
+
+    def __report(self, attempts, start_time):
+        elapsed = time() - start_time
+        self.last_attempts = attempts
+        self.last_hash_rate = attempts / elapsed if elapsed > 0 else 0.0
+
+    def search(self, transactions, last_hash, difficulty=DIFFICULTY, merkle_root=None, cancel=None):
+        """ Return a valid proof for the transactions (or their Merkle root if given) on top of the last hash
+
+        Arguments:
+            :cancel: Optional threading.Event, the search gives up and returns None once it is set
+        """
+        with self.__lock:
+            start_time = time()
+            self.searching = True
+            self.__report(0, start_time)
+            prefix = proof_prefix(transactions, last_hash, merkle_root) # serialized once per search, not per proof
+            target = proof_target(difficulty)
+            try:
+                if self.workers == 1:
+                    midstate = sha256(prefix)
+                    start = 0
+                    proof = None
+                    while proof is None and not (cancel is not None and cancel.is_set()):
+                        proof = _try_proofs(midstate, target, start, start + CHUNK_SIZE)
+                        start += CHUNK_SIZE
+                        self.__report(start, start_time)
+                    attempts = start if proof is None else proof + 1
+                else:
+                    self.__start_pool()
+                    self.__found.clear()
+                    self.__progress.value = 0
+                    pending = [self.__pool.apply_async(_search, (worker, self.workers, prefix, target)) for worker in range(self.workers)]
+                    while not all(result.ready() for result in pending):
+                        if cancel is not None and cancel.is_set():
+                            self.__found.set() # stops the workers like a found proof
+                        next(result for result in pending if not result.ready()).wait(0.05)
+                        self.__report(self.__progress.value, start_time)
+                    results = [result.get() for result in pending]
+                    proofs = [proof for proof, _ in results if proof is not None]
+                    proof = min(proofs) if proofs else None
+                    attempts = sum(worker_attempts for _, worker_attempts in results)
+                self.__report(attempts, start_time)
+                return proof
+            finally:
+                self.searching = False
+
+    def close(self):
+        """ Stop the worker processes """
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool = None
@@ -1,5 +1,6 @@
 class Printable():
+    __slots__ = () # no per-instance __dict__, subclasses list their fields in __slots__
 
-    # like a to_String method that returns a string
+    # like a to_String method that returns a string of the public fields
     def __repr__(self):
-        return str(self.__dict__)
\ No newline at end of file
+        return str({name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')})
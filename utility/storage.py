@@ -0,0 +1,586 @@
+""" Provides the on-disk storage engine of a node """
+
+from array import array
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from utility.codec import decode_block, encode_block
+from utility.lru_cache import LRUCache
+from utility import metrics
+
+SEGMENT_BLOCKS = 1000 # blocks per segment file of the block log
+CHECKPOINTS_KEPT = 3 # older checkpoints get deleted when a new one is written
+ARCHIVE_FRAME_BLOCKS = 32 # blocks compressed together in an archive segment, read back a frame at a time
+ARCHIVE_FRAME_CACHE = 8 # decompressed frames kept in memory, sequential reads decompress each frame once
+JSON = 'json'
+BINARY = 'binary'
+
+_RECORD_LENGTH = struct.Struct('>I') # prefix of every block in a binary segment
+_ARCHIVE_COUNT = struct.Struct('>Q') # number of blocks of an archive segment, at its very end
+_ARCHIVE_ENTRY = 4 # frame offset, frame length, offset in the decompressed frame, block length per block
+
+_operation_seconds = metrics.histogram('blockchain_storage_seconds', 'Time spent on storage operations, from loading the whole node state to one block append or journal fsync', ('operation',)) # shared with blockchain.py
+
+
+class Storage:
+    """ Stores the data of one node in the folder blockchain-<node_id>:
+        blocks-<n>.log: append-only segments holding one JSON block per line, or
+        blocks-<n>.bin: the same in the binary format of utility.codec, every block prefixed with its length
+        blocks-<n>.arc: an archived (cold) segment, immutable: its blocks compressed ARCHIVE_FRAME_BLOCKS at a time
+            with zlib, followed by the frame offset, frame length, offset in the frame and length of every block
+            and the number of blocks. Written for every full segment before the last one when archiving is on
+        blocks.idx: offset and length of every block in its segment, by height
+        mempool.journal: write-ahead journal of the open transactions, one JSON transaction or
+            {"removed": [transaction ids]} record per line
+        peers.json: the set of peer nodes
+        checkpoint-<height>.json: derived state (the ledger's totals, the address index) as of a block height, with that block's hash
+        addresses.log: the entries of the address index, one {"height", "hash", "entries"} record per block
+            or {"revert": height} line. Derived from the blocks, so it's not fsynced and gets rebuilt if it doesn't match
+
+    Attributes:
+        :path: The folder holding the files of the node
+        :block_format: JSON or BINARY, a folder which already holds blocks keeps its format
+        :archive: Whether full segments get compressed into archive segments. Archives are read either way
+    """
+    def __init__(self, node_id, block_format=BINARY, archive=False):
+        self.path = 'blockchain-{}'.format(node_id)
+        self.block_format = block_format
+        self.archive = archive
+        self.__legacy_file = 'blockchain-{}.txt'.format(node_id)
+        self.__lock = threading.Lock() # guards the open file handles
+        self.__sync_lock = threading.Lock() # only one fsync of the journal at a time
+        self.__journal = None
+        self.__journal_written = 0 # number of journal records written so far
+        self.__journal_synced = 0 # number of journal records known to be on disk
+        self.__index = array('Q') # offset, length pairs of the stored blocks by height
+        self.__maps = {} # memory maps of the segments, by segment number
+        self.__footers = LRUCache(ARCHIVE_FRAME_CACHE) # block tables of the archive segments, by segment number
+        self.__frames = LRUCache(ARCHIVE_FRAME_CACHE) # decompressed archive frames, by (segment, frame offset)
+        os.makedirs(self.path, exist_ok=True)
+        for existing_format in (JSON, BINARY):
+            if self.__segments(existing_format):
+                self.block_format = existing_format
+        self.__archived = set(self.__archives())
+        self.__migrate()
+        self.__open_index()
+        if self.archive:
+            self.__archive_full_segments() # e.g. a node which ran without archiving before
+
+    def __file(self, name):
+        return os.path.join(self.path, name)
+
+    def __extension(self, block_format=None):
+        return '.bin' if (block_format or self.block_format) == BINARY else '.log'
+
+    def __segment_file(self, segment):
+        return self.__file('blocks-{:06d}{}'.format(segment, self.__extension()))
+
+    def __segments(self, block_format=None):
+        """ Return the numbers of the (not archived) segments on disk in order """
+        extension = self.__extension(block_format)
+        return sorted(int(name[7:13]) for name in os.listdir(self.path) if name.startswith('blocks-') and name.endswith(extension))
+
+    def __archive_file(self, segment):
+        return self.__file('blocks-{:06d}.arc'.format(segment))
+
+    def __archives(self):
+        """ Return the numbers of the archived segments on disk in order """
+        return sorted(int(name[7:13]) for name in os.listdir(self.path) if name.startswith('blocks-') and name.endswith('.arc'))
+
+    def __encode_record(self, block):
+        """ Return a block dict framed for its segment as (bytes, offset of the block in them, length of the block) """
+        if self.block_format == BINARY:
+            data = encode_block(block)
+            return _RECORD_LENGTH.pack(len(data)) + data, _RECORD_LENGTH.size, len(data)
+        data = json.dumps(block).encode()
+        return data + b'\n', 0, len(data)
+
+    def __decode_record(self, data):
+        if self.block_format == BINARY:
+            return decode_block(data)
+        return json.loads(data)
+
+    @staticmethod
+    def __write_atomic(file_name, lines):
+        """ Write a whole file next to the old one then swap them so a crash never leaves half a file """
+        tmp_file = file_name + '.tmp'
+        with open(tmp_file, mode='w') as f:
+            for line in lines:
+                f.write(line)
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_name)
+
+    @staticmethod
+    def __read_lines(file_name, offset=0):
+        """ Return the decoded JSON lines of a file from a byte offset on, dropping a torn last line left by a crash """
+        records = []
+        good_size = offset
+        try:
+            with open(file_name, mode='rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good_size += len(line)
+        except IOError:
+            return records
+        if good_size != os.path.getsize(file_name):
+            with open(file_name, mode='r+') as f:
+                f.truncate(good_size) # cut the torn write so that the next append starts on a clean line
+        return records
+
+    def __migrate(self):
+        """ One-time import of the old single-file format blockchain-<node_id>.txt """
+        if self.__segments() or not os.path.exists(self.__legacy_file):
+            return
+        try:
+            with open(self.__legacy_file, mode='r') as f:
+                file_content = f.readlines()
+            blocks = json.loads(file_content[0][:-1])
+            open_transactions = json.loads(file_content[1][:-1]) if len(file_content) > 1 else []
+            peer_nodes = json.loads(file_content[2]) if len(file_content) > 2 else []
+        except (IOError, IndexError, ValueError):
+            print('Migrating {} failed!'.format(self.__legacy_file))
+            return
+        self.__write_blocks(blocks, 0)
+        self.__write_atomic(self.__file('mempool.journal'), [json.dumps(tx) for tx in open_transactions])
+        self.__write_atomic(self.__file('peers.json'), [json.dumps(peer_nodes)])
+        os.replace(self.__legacy_file, self.__legacy_file + '.migrated') # keep the old file around but never migrate twice
+        print('Migrated {} to {}'.format(self.__legacy_file, self.path))
+
+    def __scan_segment(self, segment):
+        """ Return the offset, length pairs of the blocks of a segment, dropping a torn last record """
+        entries = []
+        file_name = self.__segment_file(segment)
+        offset = 0
+        with open(file_name, mode='rb') as f:
+            if self.block_format == BINARY:
+                data = f.read()
+                while offset + _RECORD_LENGTH.size <= len(data):
+                    (length,) = _RECORD_LENGTH.unpack_from(data, offset)
+                    start = offset + _RECORD_LENGTH.size
+                    try:
+                        decode_block(data[start:start + length])
+                    except ValueError:
+                        break
+                    entries.append((start, length))
+                    offset = start + length
+            else:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        break
+                    entries.append((offset, len(line) - 1))
+                    offset += len(line)
+        if offset != os.path.getsize(file_name):
+            with open(file_name, mode='r+') as f:
+                f.truncate(offset)
+        return entries
+
+    def __open_index(self):
+        """ Load the offset index, rebuilding it from the segments if it doesn't match them (old folder or crash) """
+        self.__index = array('Q')
+        try:
+            with open(self.__file('blocks.idx'), mode='rb') as f:
+                self.__index.frombytes(f.read())
+        except IOError:
+            pass
+        segments = self.__segments()
+        height = len(self.__index) // 2
+        if height and segments and segments[-1] == (height - 1) // SEGMENT_BLOCKS:
+            offset, length = self.__index[-2], self.__index[-1]
+            end = offset + length + (0 if self.block_format == BINARY else 1) # JSON blocks end with a newline
+            if os.path.getsize(self.__segment_file(segments[-1])) == end:
+                return
+        elif not height and not segments:
+            return
+        print('Rebuilding block index of {}'.format(self.path))
+        self.__index = array('Q')
+        for segment in sorted(set(segments) | self.__archived):
+            if segment in self.__archived:
+                footer = self.__archive_footer(segment)
+                for position in range(0, len(footer), _ARCHIVE_ENTRY):
+                    self.__index.extend((0, footer[position + 3])) # only the length is used for archived blocks
+            else:
+                for offset, length in self.__scan_segment(segment):
+                    self.__index.extend((offset, length))
+        self.__write_index()
+
+    def __write_index(self):
+        tmp_file = self.__file('blocks.idx.tmp')
+        with open(tmp_file, mode='wb') as f:
+            f.write(self.__index.tobytes())
+        os.replace(tmp_file, self.__file('blocks.idx'))
+
+    def __write_blocks(self, blocks, from_height):
+        """ Rewrite the block log from a given height on with a list of block dicts starting at that height.
+            Readers are never shown a half written chain: the blocks below from_height keep their offsets (they
+            are encoded the same again), new segments replace the old files atomically and the index is swapped
+            in one step at the end. Readers holding a memory map of a replaced file keep seeing the old one """
+        first_segment = from_height // SEGMENT_BLOCKS
+        kept = []
+        for height in range(first_segment * SEGMENT_BLOCKS, min(from_height, self.height)):
+            kept.append(self.read_block(height))
+        old_segments = [segment for segment in self.__segments() if segment >= first_segment]
+        old_archives = [segment for segment in sorted(self.__archived) if segment >= first_segment] # a fork deeper than the hot segment
+        index = self.__index[:2 * first_segment * SEGMENT_BLOCKS]
+        all_blocks = kept + list(blocks)
+        written = set()
+        for start in range(0, len(all_blocks), SEGMENT_BLOCKS):
+            segment = first_segment + start // SEGMENT_BLOCKS
+            records = [self.__encode_record(block) for block in all_blocks[start:start + SEGMENT_BLOCKS]]
+            tmp_file = self.__segment_file(segment) + '.tmp'
+            with open(tmp_file, mode='wb') as f:
+                for data, _, _ in records:
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.__segment_file(segment))
+            self.__maps.pop(segment, None)
+            written.add(segment)
+            offset = 0
+            for data, start_in_record, length in records:
+                index.extend((offset + start_in_record, length))
+                offset += len(data)
+        self.__archived.difference_update(old_archives) # their blocks are in plain segments again
+        self.__index = index
+        for segment in old_segments:
+            if segment not in written:
+                self.__maps.pop(segment, None)
+                os.remove(self.__segment_file(segment))
+        for segment in old_archives:
+            self.__maps.pop(('archive', segment), None)
+            os.remove(self.__archive_file(segment))
+        if old_archives:
+            self.__footers.clear()
+            self.__frames.clear()
+        self.__write_index()
+        if self.archive:
+            self.__archive_full_segments()
+
+    # Archive segments
+
+    def __archive_full_segments(self):
+        """ Archive every segment below the one the next block goes to, the last block always stays in a plain segment """
+        last_segment = (self.height - 1) // SEGMENT_BLOCKS
+        for segment in self.__segments():
+            if segment < last_segment:
+                self.__archive_segment(segment)
+
+    def __archive_segment(self, segment):
+        """ Compress a full segment into its archive file then remove the plain one """
+        first = segment * SEGMENT_BLOCKS
+        frames = []
+        footer = array('Q')
+        offset = 0
+        for frame_start in range(first, first + SEGMENT_BLOCKS, ARCHIVE_FRAME_BLOCKS):
+            raw = []
+            in_frame = 0
+            for height in range(frame_start, min(frame_start + ARCHIVE_FRAME_BLOCKS, first + SEGMENT_BLOCKS)):
+                data = self.__read_record(height)
+                footer.extend((offset, 0, in_frame, len(data))) # the frame length is known once it's compressed
+                raw.append(data)
+                in_frame += len(data)
+            frame = zlib.compress(b''.join(raw))
+            for position in range(len(footer) - _ARCHIVE_ENTRY * len(raw), len(footer), _ARCHIVE_ENTRY):
+                footer[position + 1] = len(frame)
+            frames.append(frame)
+            offset += len(frame)
+        tmp_file = self.__archive_file(segment) + '.tmp'
+        with open(tmp_file, mode='wb') as f:
+            for frame in frames:
+                f.write(frame)
+            f.write(footer.tobytes())
+            f.write(_ARCHIVE_COUNT.pack(len(footer) // _ARCHIVE_ENTRY))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.__archive_file(segment))
+        self.__archived.add(segment)
+        self.__maps.pop(segment, None) # readers holding the old map keep a valid view of the removed file
+        os.remove(self.__segment_file(segment))
+
+    def __archive_map(self, segment):
+        key = ('archive', segment)
+        archive_map = self.__maps.get(key)
+        if archive_map is None:
+            with open(self.__archive_file(segment), mode='rb') as f:
+                archive_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[key] = archive_map
+        return archive_map
+
+    def __archive_footer(self, segment):
+        """ Return the block table of an archive segment: frame offset, frame length, offset in the frame and length per block """
+        footer = self.__footers.get(segment)
+        if footer is None:
+            archive_map = self.__archive_map(segment)
+            (count,) = _ARCHIVE_COUNT.unpack_from(archive_map, len(archive_map) - _ARCHIVE_COUNT.size)
+            end = len(archive_map) - _ARCHIVE_COUNT.size
+            footer = array('Q')
+            footer.frombytes(archive_map[end - count * _ARCHIVE_ENTRY * footer.itemsize:end])
+            self.__footers.put(segment, footer)
+        return footer
+
+    def __read_archived(self, height):
+        segment = height // SEGMENT_BLOCKS
+        footer = self.__archive_footer(segment)
+        position = (height - segment * SEGMENT_BLOCKS) * _ARCHIVE_ENTRY
+        frame_offset, frame_length, offset, length = footer[position:position + _ARCHIVE_ENTRY]
+        frame = self.__frames.get((segment, frame_offset))
+        if frame is None:
+            frame = zlib.decompress(self.__archive_map(segment)[frame_offset:frame_offset + frame_length])
+            self.__frames.put((segment, frame_offset), frame)
+        return frame[offset:offset + length]
+
+    # Blocks
+
+    @property
+    def height(self):
+        """ The number of stored blocks """
+        return len(self.__index) // 2
+
+    def read_block(self, height):
+        """ Decode a single stored block from the memory mapped segment holding it """
+        return self.__decode_record(self.__read_record(height))
+
+    def __read_record(self, height):
+        """ Return the encoded block at a height, from its plain or archived segment """
+        segment = height // SEGMENT_BLOCKS
+        if segment in self.__archived:
+            try:
+                return self.__read_archived(height)
+            except FileNotFoundError:
+                if segment in self.__archived:
+                    raise
+                # rewritten as a plain segment by a chain replacement meanwhile
+        index = self.__index # one index, it may get swapped by a chain replacement
+        offset, length = index[2 * height], index[2 * height + 1]
+        segment_map = self.__maps.get(segment)
+        if segment_map is None or len(segment_map) < offset + length:
+            # Map (again) as appended blocks lie beyond the end of an older map
+            try:
+                with open(self.__segment_file(segment), mode='rb') as f:
+                    segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                if segment in self.__archived: # archived by another thread meanwhile
+                    return self.__read_archived(height)
+                raise
+            self.__maps[segment] = segment_map
+        return segment_map[offset:offset + length]
+
+    def load_blocks(self):
+        """ Return all stored blocks as dicts in chain order """
+        return [self.read_block(height) for height in range(self.height)]
+
+    def append_block(self, block):
+        """ Append one block dict at the end of the block log. Returns False if it couldn't be stored, e.g. a field
+            the block format can't hold, the caller then leaves the block out of its chain too """
+        with self.__lock, _operation_seconds.time(operation='append_block'):
+            try:
+                data, start, length = self.__encode_record(block) # before anything gets written
+                with open(self.__segment_file(self.height // SEGMENT_BLOCKS), mode='ab') as f:
+                    offset = f.tell()
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.__index.extend((offset + start, length))
+            except (IOError, ValueError) as error:
+                print('Saving block failed! {}'.format(error))
+                return False
+            try:
+                with open(self.__file('blocks.idx'), mode='ab') as f:
+                    f.write(self.__index[-2:].tobytes()) # a lost entry gets rebuilt from the segment at startup
+                if self.archive and self.height % SEGMENT_BLOCKS == 1 and self.height > 1:
+                    self.__archive_segment(self.height // SEGMENT_BLOCKS - 1) # the first block of a new segment, the one before is full
+            except IOError:
+                print('Saving block index failed!') # the block itself is stored
+            return True
+
+    def replace_blocks(self, blocks, from_height=0):
+        """ Replace the stored blocks from a given height on, e.g. after resolving a conflict
+
+        Arguments:
+            :blocks: The block dicts which start at from_height
+            :from_height: The first height which differs from the stored chain
+        """
+        with self.__lock, _operation_seconds.time(operation='replace_blocks'):
+            try:
+                self.__write_blocks(blocks, from_height)
+            except IOError:
+                print('Saving chain failed!')
+
+    # Open transactions
+
+    def load_open_transactions(self):
+        """ Return the records of the journal in order: transaction dicts and {'removed': [transaction ids]} """
+        return self.__read_lines(self.__file('mempool.journal'))
+
+    def append_open_transaction(self, transaction, sync=True):
+        """ Record one open transaction dict in the journal
+
+        Arguments:
+            :sync: Whether to wait until the record is on disk, else pass the returned record number to
+                sync_journal later, e.g. after releasing a lock that orders the records
+
+        Returns:
+            The number of the record in the journal, None if writing failed
+        """
+        return self.__append_journal(transaction, sync)
+
+    def remove_open_transactions(self, tx_ids, sync=True):
+        """ Record that open transactions left the pool (included in a block or evicted), see append_open_transaction """
+        if tx_ids:
+            return self.__append_journal({'removed': list(tx_ids)}, sync)
+        return None
+
+    def __append_journal(self, record, sync):
+        with self.__lock:
+            try:
+                if self.__journal is None:
+                    self.__journal = open(self.__file('mempool.journal'), mode='a')
+                self.__journal.write(json.dumps(record))
+                self.__journal.write('\n')
+                self.__journal.flush()
+            except IOError:
+                print('Saving transaction failed!')
+                return None
+            self.__journal_written += 1
+            record = self.__journal_written
+        if sync:
+            self.sync_journal(record)
+        return record
+
+    def sync_journal(self, record):
+        """ Make sure the journal is on disk up to a record number returned by an append.
+
+        Writers that arrive while another thread is syncing the journal get their record
+        flushed by the next single fsync instead of paying one each (group commit).
+        """
+        if record is None:
+            return
+        with self.__sync_lock, _operation_seconds.time(operation='sync_journal'): # includes waiting for another writer's fsync
+            if self.__journal_synced >= record:
+                return # another writer's fsync already covered this record
+            with self.__lock:
+                if self.__journal is None: # the journal got rewritten in the meantime, which syncs it
+                    return
+                target = self.__journal_written
+                fd = os.dup(self.__journal.fileno()) # sync outside the lock so other writers can keep appending
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.__journal_synced = max(self.__journal_synced, target)
+
+    def write_open_transactions(self, transactions):
+        """ Rewrite the journal with the given open transaction dicts, e.g. after some got mined """
+        with self.__lock, _operation_seconds.time(operation='write_open_transactions'):
+            if self.__journal is not None:
+                self.__journal.close()
+                self.__journal = None
+            try:
+                self.__write_atomic(self.__file('mempool.journal'), [json.dumps(tx) for tx in transactions])
+            except IOError:
+                print('Saving open transactions failed!')
+            self.__journal_synced = self.__journal_written
+
+    # Checkpoints
+
+    def checkpoint_heights(self):
+        """ Return the heights of the stored checkpoints, the latest first """
+        return sorted((int(name[11:20]) for name in os.listdir(self.path) if name.startswith('checkpoint-') and name.endswith('.json')), reverse=True)
+
+    def read_checkpoint(self, height):
+        """ Return the checkpoint dict stored for a height, None if it's missing or unreadable """
+        records = self.__read_lines(self.__file('checkpoint-{:09d}.json'.format(height)))
+        return records[0] if records else None
+
+    def write_checkpoint(self, checkpoint):
+        """ Store a checkpoint dict with at least its 'height' and 'hash', only the latest few are kept """
+        with self.__lock, _operation_seconds.time(operation='write_checkpoint'):
+            try:
+                self.__write_atomic(self.__file('checkpoint-{:09d}.json'.format(checkpoint['height'])), [json.dumps(checkpoint)])
+            except IOError:
+                print('Saving checkpoint failed!')
+                return
+        for height in self.checkpoint_heights()[CHECKPOINTS_KEPT:]:
+            self.__remove_checkpoint(height)
+
+    def drop_checkpoints(self, above_height):
+        """ Delete the checkpoints beyond a height, e.g. of blocks a fork replaced """
+        for height in self.checkpoint_heights():
+            if height > above_height:
+                self.__remove_checkpoint(height)
+
+    def __remove_checkpoint(self, height):
+        try:
+            os.remove(self.__file('checkpoint-{:09d}.json'.format(height)))
+        except OSError:
+            pass
+
+    # Address index
+
+    def load_address_log(self, offset=0):
+        """ Return the records of the address index log in order, from a byte offset (see address_log_size) on.
+            None if the offset is not where a record of the log starts, e.g. the log got rewritten since """
+        if offset:
+            try:
+                with open(self.__file('addresses.log'), mode='rb') as f:
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':
+                        return None
+            except IOError:
+                return None
+        return self.__read_lines(self.__file('addresses.log'), offset)
+
+    def address_log_size(self):
+        """ Return the size of the address index log, the offset of the next record appended to it """
+        with self.__lock:
+            try:
+                return os.path.getsize(self.__file('addresses.log'))
+            except OSError:
+                return 0
+
+    def append_address_records(self, records):
+        with self.__lock:
+            try:
+                with open(self.__file('addresses.log'), mode='a') as f:
+                    for record in records:
+                        f.write(json.dumps(record))
+                        f.write('\n')
+            except IOError:
+                print('Saving address index failed!')
+
+    def write_address_log(self, records):
+        """ Rewrite the address index log with only the given block records, e.g. after a fork left revert records in it """
+        with self.__lock:
+            try:
+                self.__write_atomic(self.__file('addresses.log'), [json.dumps(record) for record in records])
+            except IOError:
+                print('Saving address index failed!')
+
+    # Peer nodes
+
+    def load_peer_nodes(self):
+        """ Return the stored list of peer nodes """
+        records = self.__read_lines(self.__file('peers.json'))
+        return records[0] if records else []
+
+    def write_peer_nodes(self, peer_nodes):
+        with self.__lock:
+            try:
+                self.__write_atomic(self.__file('peers.json'), [json.dumps(list(peer_nodes))])
+            except IOError:
+                print('Saving peer nodes failed!')
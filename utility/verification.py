@@ -1,35 +1,96 @@
 """ Provides verification helper methods """ # docstring for the module in the package
 
-from utility.hash_util import hash_string_256, hash_block
+from hashlib import sha256
+
+from utility.hash_util import hash_block, merkle_leaf, merkle_node, merkle_root, proof_prefix, proof_target
 from wallet import Wallet
+from utility import metrics
+
+_verify_chain_seconds = metrics.histogram('verification_verify_chain_seconds', 'Time to verify the hashes and proofs of a chain')
+_blocks_checked = metrics.counter('verification_blocks_checked_total', 'Blocks whose hash link and proof of work were checked')
+
+DIFFICULTY = 8 # leading zero bits of a valid PoW hash, 8 is the original "hex hash starts with '00'" rule
 
 class Verification():
     @staticmethod # for independent method
-    def valid_proof(transactions, last_hash, proof):
-        """PoW check based on proof & a condition (hash starts with '00') as transactions and last hash are static"""
-        # Create a string with all the hash inputs with transactions as OrderedDict
-        guess = (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode()
-        # print(guess) # Debug: shows transactions as OrderedDict
-        guess_hash = hash_string_256(guess)  # hash the string guess
-        # print(guess_hash)
-        return guess_hash[0:2] == "00"
+    def valid_proof(transactions, last_hash, proof, difficulty=DIFFICULTY, merkle_root=None):
+        """PoW check based on proof & a condition (hash has 'difficulty' leading zero bits) as transactions and last hash are static.
+           With a Merkle root the proof covers the root instead of the transactions"""
+        # Hash the transactions as OrderedDict (or the root) + last hash, then the proof
+        guess = sha256(proof_prefix(transactions, last_hash, merkle_root))
+        guess.update(str(proof).encode())
+        return guess.digest() <= proof_target(difficulty) # same as the hex hash starting with '00' for difficulty 8
+
+    @classmethod
+    def valid_block_proof(cls, block, difficulty=DIFFICULTY):
+        """PoW check of a block: over its Merkle root, which has to match its transactions, or for
+           legacy blocks without a root over the transactions excluding the reward transaction.
+           A block holding the same transaction twice is never valid"""
+        if type(block.previous_hash) is not str or not all(cls.valid_transaction_fields(tx.sender, tx.recipient, tx.signature, tx.amount) for tx in block.transactions):
+            print("Block holds malformed transactions")
+            return False
+        tx_ids = [tx.id for tx in block.transactions]
+        if len(set(tx_ids)) != len(tx_ids):
+            print("Block holds the same transaction more than once")
+            return False
+        if block.merkle_root is None:
+            return cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof, difficulty)
+        if block.merkle_root != merkle_root(tx_ids):
+            print("Merkle root doesn't match the transactions of the block")
+            return False
+        return cls.valid_proof(None, block.previous_hash, block.proof, difficulty, block.merkle_root)
+
+    @staticmethod
+    def verify_merkle_proof(tx_id, path, root):
+        """Check that a transaction is part of a block knowing only the block's Merkle root
+
+        Arguments:
+            :tx_id: The id of the transaction
+            :path: The inclusion proof as returned by GET /block/<index>/proof/<tx_id>, the sibling hashes
+                from the bottom of the tree up with their position ('left' or 'right')
+            :root: The Merkle root of the block
+        """
+        try:
+            current = merkle_leaf(tx_id)
+            for step in path:
+                if step['position'] == 'left':
+                    current = merkle_node(bytes.fromhex(step['hash']), current)
+                else:
+                    current = merkle_node(current, bytes.fromhex(step['hash']))
+        except (ValueError, TypeError, KeyError):
+            return False
+        return current.hex() == root
     
     @classmethod # for method that depends on others. cls replaces self
-    def verify_chain(cls, blockchain): # cls substitutes self for @classmethod
-        """Compare the stored hash in a given block with the re-calculated hash of the previous block"""
-        for index, block in enumerate(blockchain):
-            if index == 0:
-                continue
-            if block.previous_hash != hash_block(blockchain[index - 1]):
-                print(
-                    "Stored hash in current block is not equal to previous hash of previous block"
-                )
-                return False
-            # Call valid_proof excluding the reward transaction in transactions
-            if not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
-                print("Proof of Work - PoW is invalid!")
+    def verify_chain(cls, blockchain, difficulty=DIFFICULTY, trusted_height=1): # cls substitutes self for @classmethod
+        """Compare the stored hash in a given block with the re-calculated hash of the previous block
+
+        Arguments:
+            :blockchain: The blocks to check
+            :difficulty: The leading zero bits of a valid PoW hash
+            :trusted_height: The blocks below that height were already validated (e.g. our block a peer's blocks
+                extend) and only the ones after get checked. The first block has nothing to be checked against,
+                a chain without trusted blocks is invalid
+        """
+        with _verify_chain_seconds.time():
+            if blockchain and trusted_height < 1:
+                print("First block can't be verified, e.g. a different genesis block")
                 return False
-        return True
+            for index in range(trusted_height, len(blockchain)):
+                block = blockchain[index]
+                _blocks_checked.inc()
+                if block.previous_hash != hash_block(blockchain[index - 1]):
+                    print(
+                        "Stored hash in current block is not equal to previous hash of previous block"
+                    )
+                    return False
+                if block.index != blockchain[index - 1].index + 1: # the address index and checkpoints go by it
+                    print("Block index doesn't follow the previous block's")
+                    return False
+                if not cls.valid_block_proof(block, difficulty):
+                    print("Proof of Work - PoW is invalid!")
+                    return False
+            return True
     
     @staticmethod
     def verify_transaction(transaction, get_balance, check_funds=True):
@@ -42,9 +103,23 @@ class Verification():
             return sender_balance >= transaction.amount and Wallet.verify_tx_signature(transaction) # only when add_transaction
         return Wallet.verify_tx_signature(transaction) # from user_choice == 4 we already passed the fund check
     
-    @classmethod
-    def verify_transactions(cls, open_transactions, get_balance):
-        """ Verify the validity of all transaction by checking just the signature """
-        return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
+    @staticmethod
+    def valid_transaction_fields(sender, recipient, signature, amount):
+        """ Check that the keys and the signature of a transaction are texts and its amount a number,
+            the only values the block formats and the ledger take """
+        return (
+            all(type(text) is str for text in (sender, recipient, signature))
+            and isinstance(amount, (int, float)) and not isinstance(amount, bool)
+        )
+
+    @staticmethod
+    def valid_amount(amount):
+        """ Check that an amount is a positive number, e.g. before comparing it with a balance """
+        return isinstance(amount, (int, float)) and not isinstance(amount, bool) and 0 < amount < float('inf')
+
+    @staticmethod
+    def verify_transactions(open_transactions, get_balance, workers=1):
+        """ Verify the validity of all transaction by checking just the signature, as one batch """
+        return all(Wallet.verify_tx_signatures(open_transactions, workers))
     
     
\ No newline at end of file
@@ -3,6 +3,59 @@ from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 import Crypto.Random
 import binascii
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+
+from utility.lru_cache import LRUCache
+from utility import metrics
+
+BATCH_THRESHOLD = 16 # smaller batches are verified in the calling process, shipping them costs more than it saves
+
+_verify_pools = {} # process pools for signature checks by number of workers
+_verifiers = LRUCache(1024) # parsed PKCS1_v1_5 verifiers by sender public key hex
+_verified = LRUCache(65536) # (payload digest, signature) pairs which already passed verification
+
+_sign_seconds = metrics.histogram('wallet_sign_seconds', 'Time to sign a transaction')
+_verify_seconds = metrics.histogram('wallet_verify_seconds', 'Time to verify one signature or a batch of them', ('mode',))
+_signatures = metrics.counter('wallet_signatures_verified_total', 'Signatures verified, cache hits included', ('result',)) # counted in this process, also for the batches run in workers
+_caches = {'public_keys': _verifiers, 'signatures': _verified}
+_cache_entries = metrics.gauge('wallet_cache_entries', 'Entries in the parsed public key and verified signature caches of this process', ('cache',))
+_cache_hits = metrics.gauge('wallet_cache_hits', 'Lookups answered by the parsed public key and verified signature caches of this process', ('cache',))
+_cache_misses = metrics.gauge('wallet_cache_misses', 'Lookups missed by the parsed public key and verified signature caches of this process', ('cache',))
+_cache_entries.set_function(lambda: {(name,): len(cache) for name, cache in _caches.items()})
+_cache_hits.set_function(lambda: {(name,): cache.hits for name, cache in _caches.items()})
+_cache_misses.set_function(lambda: {(name,): cache.misses for name, cache in _caches.items()})
+
+
+def _memo_key(sender, recipient, amount, signature):
+    return (hashlib.sha256((str(sender) + str(recipient) + str(amount)).encode('utf8')).digest(), signature)
+
+
+def _well_formed(sender, signature):
+    # The caches are keyed by them, anything but texts (e.g. a list from a peer's JSON) is no valid signature anyway
+    return type(sender) is str and type(signature) is str
+
+
+def _verify_signature(sender, recipient, amount, signature):
+    """ Check one signature, a module level function so that worker processes can run it.
+        Every process keeps its own caches of parsed keys and verified signatures """
+    if not _well_formed(sender, signature):
+        return False
+    memo_key = _memo_key(sender, recipient, amount, signature)
+    if _verified.get(memo_key):
+        return True # same transaction checked before, e.g. at admission and now at mining
+    try:
+        verifier = _verifiers.get(sender)
+        if verifier is None:
+            verifier = PKCS1_v1_5.new(RSA.import_key(binascii.unhexlify(sender)))
+            _verifiers.put(sender, verifier)
+        hash_pl = SHA256.new((str(sender) + str(recipient) + str(amount)).encode('utf8'))
+        valid = verifier.verify(hash_pl, binascii.unhexlify(signature))
+    except (ValueError, TypeError, IndexError): # malformed key or signature, e.g. from a peer
+        return False
+    if valid:
+        _verified.put(memo_key, True) # only successes are remembered, a bad signature costs a full check each time
+    return valid
 
 # Wallet holds a key, value pair which is private_key, public_key
 class Wallet:
@@ -10,6 +63,7 @@ class Wallet:
         self.private_key = None 
         self.public_key = None
         self.node_id = node_id
+        self.__signer = None # (private key hex, PKCS1_v1_5 signer) so the key is parsed once per wallet load, not per signature
 
     # Create the keys and set their values in Wallet class
     def create_keys(self):
@@ -53,10 +107,18 @@ class Wallet:
     
     # Sign a transaction with the private_key
     def sign_transaction(self, sender, recipient, amount):
-        signer= PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(self.private_key)))
-        hash_payload = SHA256.new((str(sender) + str(recipient) + str(amount)).encode('utf8'))
-        signature = signer.sign(hash_payload)
+        with _sign_seconds.time():
+            signer = self.__get_signer()
+            hash_payload = SHA256.new((str(sender) + str(recipient) + str(amount)).encode('utf8'))
+            signature = signer.sign(hash_payload)
         return binascii.hexlify(signature).decode('ascii')
+
+    def __get_signer(self):
+        signer = self.__signer
+        if signer is None or signer[0] != self.private_key: # new keys were created or loaded
+            signer = (self.private_key, PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(self.private_key))))
+            self.__signer = signer
+        return signer[1]
     
     # Verify the signature of transaction
     @staticmethod
@@ -65,8 +127,56 @@ class Wallet:
         Arguments:
            :transaction: The transaction that should be verified
         """
-        public_key = RSA.import_key(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        hash_pl = SHA256.new((str(transaction.sender) + str(transaction.recipient) + str(transaction.amount)).encode('utf8')) 
+        with _verify_seconds.time(mode='single'):
+            valid = _verify_signature(transaction.sender, transaction.recipient, transaction.amount, transaction.signature)
+        _signatures.inc(result='valid' if valid else 'invalid')
+        return valid
 
-        return verifier.verify(hash_pl, binascii.unhexlify(transaction.signature))
\ No newline at end of file
+    @staticmethod
+    def verify_tx_signatures(transactions, workers=1):
+        """ Verify the signatures of many transactions at once, spread over a pool of processes
+
+        Arguments:
+           :transactions: The transactions that should be verified
+           :workers: The number of worker processes to use
+        Returns:
+           A list with True or False per transaction, in the same order
+        """
+        with _verify_seconds.time(mode='batch'):
+            results = Wallet.__verify_batch(transactions, workers)
+        valid_count = sum(results)
+        _signatures.inc(valid_count, result='valid')
+        _signatures.inc(len(results) - valid_count, result='invalid')
+        return results
+
+    @staticmethod
+    def __verify_batch(transactions, workers):
+        signed = [(tx.sender, tx.recipient, tx.amount, tx.signature) for tx in transactions]
+        if workers <= 1 or len(signed) < BATCH_THRESHOLD:
+            return [_verify_signature(*tx) for tx in signed]
+        results = [_well_formed(tx[0], tx[3]) and bool(_verified.get(_memo_key(*tx))) for tx in signed]
+        unknown = [position for position, valid in enumerate(results) if not valid] # only ship what this process hasn't seen
+        if not unknown:
+            return results
+        if workers not in _verify_pools:
+            _verify_pools[workers] = ProcessPoolExecutor(workers)
+        chunk_size = max(1, len(unknown) // (workers * 4))
+        checked = _verify_pools[workers].map(_verify_signature, *zip(*[signed[position] for position in unknown]), chunksize=chunk_size)
+        for position, valid in zip(unknown, checked):
+            results[position] = valid
+            if valid:
+                _verified.put(_memo_key(*signed[position]), True)
+        return results
+
+    @staticmethod
+    def configure_caches(key_cache_size=None, signature_cache_size=None):
+        """ Change the number of parsed public keys and of verified signatures kept in memory """
+        if key_cache_size is not None:
+            _verifiers.resize(key_cache_size)
+        if signature_cache_size is not None:
+            _verified.resize(signature_cache_size)
+
+    @staticmethod
+    def cache_stats():
+        """ Return the size and hit/miss counters of the public key and verified signature caches """
+        return {'public_keys': _verifiers.stats(), 'signatures': _verified.stats()}
\ No newline at end of file